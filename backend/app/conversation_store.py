@@ -1,25 +1,71 @@
 """
 Conversation Store — Global sohbet veri yapısı.
-Her NPC UUID'si altında tüm konuşma geçmişi saklanır.
-Thread-safe erişim threading.Lock ile sağlanır.
+Her NPC UUID'si altında konuşma geçmişi üç katmanda saklanır:
+  - recent:  son N mesaj (her zaman prompt'a girer)
+  - summary: recent'ten düşen mesajların LLM ile üretilmiş kümülatif özeti
+  - archive: düşen ham mesajların tamamı (sadece istenirse okunur)
+Thread-safe erişim NPC (veya session) ID'sine göre bölünmüş lock'larla
+(lock striping) sağlanır: farklı NPC'lere yapılan işlemler birbirini beklemez.
 """
 
+import os
+import asyncio
+import itertools
 import threading
+import time
+from collections import deque
+from itertools import islice
+from contextlib import ExitStack, contextmanager
+from types import MappingProxyType
 from typing import Optional
 
+# Lock stripe sayısı — 2'nin kuvveti olmalı (hash & mask ile seçilir)
+_LOCK_STRIPES = 32
+
+# NPC başına "recent" katmanında tutulan mesaj sayısı — taşan en eski mesaj
+# archive'a geçer ve özete katılmak üzere sıraya alınır
+RECENT_MESSAGES = int(os.getenv("RECENT_MESSAGES", "20"))
+
+# get_conversation'ın tek çağrıda döndürdüğü en fazla ham mesaj sayısı —
+# archive sınırsız büyüdüğü için admin görünümü sayfalanır
+CONVERSATION_PAGE_LIMIT = 100
+
+# Tek özetleme çağrısına verilen en fazla bekleyen mesaj — uzun süre başarısız
+# kalan kuyruk tek dev prompt'a dönüşmesin, kalanlar sonraki turda işlenir
+COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", "40"))
+
+# Başarısız özetlemeden sonra bekleme süresi (sn) — her ardışık hatada ikiye
+# katlanır, COMPACTION_RETRY_MAX_S ile sınırlanır
+COMPACTION_RETRY_S = 30
+COMPACTION_RETRY_MAX_S = 600
+
+# Cross-NPC özetinde son mesajdan gösterilen karakter sayısı
+_SUMMARY_PREVIEW_CHARS = 80
+
+# Her yeni konuşma kaydına verilen benzersiz nesil numarası — temizlenip yeniden
+# oluşturulan konuşmaya eski bir özetleme işinin sonucu yazılmasın diye
+_generations = itertools.count(1)
+
 
 class ConversationStore:
     """
     In-memory conversation store.
-    
+
     Yapı:
     {
         "npc_uuid": {
             "npc_id": "npc_uuid",
-            "messages": [
+            "recent": deque([
                 {"role": "user", "content": "..."},
                 {"role": "assistant", "content": "..."}
-            ]
+            ], maxlen=RECENT_MESSAGES),
+            "summary": "...",
+            "archive": [...],        # recent'ten düşen ham mesajlar
+            "pending": [...],        # henüz özete katılmamış düşen mesajlar
+            "compacting": False,     # özet güncellemesi devam ediyor mu
+            "failures": 0,           # ardışık başarısız özetleme sayısı
+            "retry_at": 0.0,         # bu an'a kadar (monotonic) özetleme denenmez
+            "generation": 1,         # kayıt (yeniden) oluşturulduğunda değişir
         }
     }
     """
@@ -27,77 +73,212 @@ class ConversationStore:
     def __init__(self):
         self._conversations: dict[str, dict] = {}
         # Geçici session chunk storage: session_id -> {index: {'text': str, 'stt_ms': float}}
+        # İç dict her zaman index sırasına göre tutulur (ekleme anında sıralanır)
         self._active_sessions: dict[str, dict[int, dict]] = {}
-        self._lock = threading.Lock()
-
-    def _ensure_conversation(self, npc_id: str) -> None:
-        """NPC için konuşma kaydı yoksa oluşturur."""
-        if npc_id not in self._conversations:
-            self._conversations[npc_id] = {
-                "npc_id": npc_id,
-                "messages": [],
-            }
+        # Eksik chunk bekleyenleri uyandırmak için session başına event
+        # (sadece event loop içinden set/await edilir)
+        self._chunk_events: dict[str, asyncio.Event] = {}
+        # Cross-NPC özet önbelleği: npc_id -> (mesaj_sayısı, son_rol, son_içerik[:80])
+        # Yazma anında bir kez hesaplanır, get_summary_for_context sadece birleştirir.
+        self._summary_cache: dict[str, tuple[int, str, str]] = {}
+        # Özet önbelleği her değiştiğinde artar; birleştirilmiş context metni
+        # exclude_npc_id başına (seq, metin) olarak saklanır ve seq eşleşirse tekrar kullanılır
+        # Farklı stripe'lardaki yazanlar aynı sayacı artırdığı için sayaç ve memo
+        # kendi küçük lock'u altında okunup yazılır (+= atomik değil)
+        self._summary_seq = 0
+        self._context_memo: dict[Optional[str], tuple[int, str]] = {}
+        self._summary_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    def _bump_summary_seq(self) -> None:
+        """Özet önbelleği değişti — memo'lanmış context metinlerini geçersiz kılar.
+        Önbellek güncellendikten sonra çağrılmalı."""
+        with self._summary_lock:
+            self._summary_seq += 1
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        """Anahtarın (npc_id / session_id) düştüğü stripe lock'unu döner."""
+        return self._stripes[hash(key) & (_LOCK_STRIPES - 1)]
+
+    @contextmanager
+    def _all_locks(self):
+        """Tüm stripe'ları sabit sırayla alır (deadlock olmaması için)."""
+        with ExitStack() as stack:
+            for lock in self._stripes:
+                stack.enter_context(lock)
+            yield
+
+    def _ensure_conversation(self, npc_id: str) -> dict:
+        """NPC için konuşma kaydı yoksa oluşturur ve kaydı döner.
+        dict.setdefault GIL altında atomik olduğu için ek lock gerekmez."""
+        conv = self._conversations.get(npc_id)
+        if conv is None:
+            conv = self._conversations.setdefault(npc_id, self._new_conversation(npc_id))
+        return conv
+
+    @staticmethod
+    def _new_conversation(npc_id: str) -> dict:
+        return {
+            "npc_id": npc_id,
+            "recent": deque(maxlen=RECENT_MESSAGES),
+            "summary": "",
+            "archive": [],
+            "pending": [],
+            "compacting": False,
+            "failures": 0,
+            "retry_at": 0.0,
+            "generation": next(_generations),
+        }
+
+    def _append_message(self, npc_id: str, role: str, text: str) -> None:
+        """Mesajı ekler ve cross-NPC özet önbelleğini günceller.
+        recent doluysa en eski mesaj archive'a ve özet kuyruğuna taşınır."""
+        with self._lock_for(npc_id):
+            conv = self._ensure_conversation(npc_id)
+            recent = conv["recent"]
+            if len(recent) == recent.maxlen:
+                evicted = recent.popleft()
+                conv["archive"].append(evicted)
+                conv["pending"].append(evicted)
+            recent.append({"role": role, "content": text})
+            self._summary_cache[npc_id] = (
+                len(conv["archive"]) + len(recent), role, text[:_SUMMARY_PREVIEW_CHARS]
+            )
+            self._bump_summary_seq()
 
     def add_user_message(self, npc_id: str, text: str) -> None:
         """Kullanıcı mesajını ekler."""
-        with self._lock:
-            self._ensure_conversation(npc_id)
-            self._conversations[npc_id]["messages"].append(
-                {"role": "user", "content": text}
-            )
+        self._append_message(npc_id, "user", text)
 
     def add_assistant_message(self, npc_id: str, text: str) -> None:
         """NPC (assistant) yanıtını ekler."""
-        with self._lock:
-            self._ensure_conversation(npc_id)
-            self._conversations[npc_id]["messages"].append(
-                {"role": "assistant", "content": text}
-            )
+        self._append_message(npc_id, "assistant", text)
 
-    def get_conversation(self, npc_id: str) -> Optional[dict]:
-        """Bir NPC'nin tüm konuşma geçmişini döner."""
-        with self._lock:
+    def get_conversation(self, npc_id: str, offset: Optional[int] = None,
+                         limit: int = CONVERSATION_PAGE_LIMIT) -> Optional[dict]:
+        """Bir NPC'nin konuşma geçmişinden bir sayfa döner (archive + recent,
+        eskiden yeniye). offset verilmezse en yeni `limit` mesaj döner.
+        Lock altında sadece istenen dilim kopyalanır, tüm archive değil."""
+        limit = max(0, min(limit, CONVERSATION_PAGE_LIMIT))
+        with self._lock_for(npc_id):
             conv = self._conversations.get(npc_id)
             if conv is None:
                 return None
-            # Derin kopya döndür, dışarıdan mutasyonu engelle
-            return {
-                "npc_id": conv["npc_id"],
-                "messages": list(conv["messages"]),
-            }
+            return self._snapshot(conv, offset, limit)
 
-    def get_messages(self, npc_id: str) -> list[dict]:
-        """Bir NPC'nin mesaj listesini döner (boş liste eğer konuşma yoksa)."""
-        with self._lock:
+    @staticmethod
+    def _snapshot(conv: dict, offset: Optional[int], limit: int) -> dict:
+        """Konuşmanın ham mesajlarından [offset, offset+limit) dilimini ve özetini döner."""
+        archive, recent = conv["archive"], conv["recent"]
+        total = len(archive) + len(recent)
+        if offset is None:
+            offset = max(total - limit, 0)
+        start, end = max(offset, 0), min(max(offset, 0) + limit, total)
+        messages = archive[start:min(end, len(archive))]
+        if end > len(archive):
+            messages.extend(islice(recent, max(start - len(archive), 0), end - len(archive)))
+        return {
+            "npc_id": conv["npc_id"],
+            "summary": conv["summary"],
+            "message_count": total,
+            "offset": start,
+            "messages": messages,
+        }
+
+    def get_history_for_prompt(self, npc_id: str) -> list[dict]:
+        """Bir NPC'nin prompt'a girecek mesajlarını döner: özet varsa başta
+        {"role": "system"} mesajı, ardından recent — son mesaj (az önce eklenen
+        kullanıcı mesajı) hariç.
+        Liste döner; LLM tarafı geçmişi indeksleyerek kırpıyor."""
+        with self._lock_for(npc_id):
             conv = self._conversations.get(npc_id)
             if conv is None:
                 return []
-            return list(conv["messages"])
-
-    def get_all_conversations(self) -> dict[str, dict]:
-        """Tüm NPC sohbetlerini döner."""
-        with self._lock:
-            result = {}
-            for npc_id, conv in self._conversations.items():
-                result[npc_id] = {
+            recent = conv["recent"]
+            history = [{"role": "system", "content": conv["summary"]}] if conv["summary"] else []
+            history.extend(islice(recent, max(len(recent) - 1, 0)))
+            return history
+
+    # ─── Özet (compaction) ──────────────────────────────────────────
+
+    def begin_compaction(self, npc_id: str) -> Optional[tuple[str, list[dict], int]]:
+        """Özete katılmayı bekleyen mesajlardan en fazla COMPACTION_BATCH tanesini
+        alır ve NPC'yi 'compacting' işaretler. Bekleyen yoksa, zaten bir özetleme
+        sürüyorsa veya son hatadan sonraki bekleme dolmadıysa None döner.
+        Returns: (mevcut_özet, bekleyen_mesajlar, nesil) — nesil finish_compaction'a
+        geri verilir"""
+        with self._lock_for(npc_id):
+            conv = self._conversations.get(npc_id)
+            if conv is None or conv["compacting"] or not conv["pending"]:
+                return None
+            if time.monotonic() < conv["retry_at"]:
+                return None
+            pending = conv["pending"][:COMPACTION_BATCH]
+            conv["pending"] = conv["pending"][COMPACTION_BATCH:]
+            conv["compacting"] = True
+            return conv["summary"], pending, conv["generation"]
+
+    def finish_compaction(self, npc_id: str, generation: int, summary: Optional[str],
+                          merged: list[dict]) -> bool:
+        """Yeni özeti kaydeder. summary None ise (özetleme başarısız)
+        merged mesajlar tekrar kuyruğun başına konur ve sonraki deneme
+        artan bir bekleme süresine ertelenir.
+        Returns: hâlâ özetlenecek mesaj var mı"""
+        with self._lock_for(npc_id):
+            conv = self._conversations.get(npc_id)
+            # Konuşma bu arada temizlendiyse (yeni kayıtta yeni bir özetleme
+            # başlamış olsa bile) eski özet yazılmaz
+            if conv is None or conv["generation"] != generation or not conv["compacting"]:
+                return False
+            conv["compacting"] = False
+            if summary is None:
+                conv["pending"] = merged + conv["pending"]
+                conv["failures"] += 1
+                delay = COMPACTION_RETRY_S * 2 ** (conv["failures"] - 1)
+                conv["retry_at"] = time.monotonic() + min(delay, COMPACTION_RETRY_MAX_S)
+                return False
+            conv["summary"] = summary
+            conv["failures"] = 0
+            return bool(conv["pending"])
+
+    def get_all_conversations(self) -> dict[str, MappingProxyType]:
+        """Tüm NPC sohbetlerinin salt-okunur özetini döner.
+        Her NPC için sadece recent katmanı (en fazla RECENT_MESSAGES mesaj)
+        tuple olarak verilir — maliyet konuşma uzunluğundan bağımsızdır.
+        Tam ham geçmiş için get_conversation(npc_id) kullanılır."""
+        with self._all_locks():
+            return {
+                npc_id: MappingProxyType({
                     "npc_id": conv["npc_id"],
-                    "messages": list(conv["messages"]),
-                }
-            return result
+                    "summary": conv["summary"],
+                    "message_count": len(conv["archive"]) + len(conv["recent"]),
+                    "messages": tuple(conv["recent"]),
+                })
+                for npc_id, conv in self._conversations.items()
+            }
+
+    def conversation_count(self) -> int:
+        """Kayıtlı konuşma sayısı — kopya/iterasyon yok, lock almaz (len atomik)."""
+        return len(self._conversations)
 
     def clear_conversation(self, npc_id: str) -> bool:
         """Bir NPC'nin konuşma geçmişini temizler. Başarılıysa True döner."""
-        with self._lock:
+        with self._lock_for(npc_id):
             if npc_id in self._conversations:
-                self._conversations[npc_id]["messages"] = []
+                self._conversations[npc_id] = self._new_conversation(npc_id)
+                self._summary_cache.pop(npc_id, None)
+                self._bump_summary_seq()
                 return True
             return False
 
     def clear_all(self) -> None:
         """Tüm konuşmaları temizler."""
-        with self._lock:
+        with self._all_locks():
             self._conversations.clear()
+            self._summary_cache.clear()
+            self._bump_summary_seq()
             self._active_sessions.clear()
+            self._chunk_events.clear()
 
     def get_summary_for_context(self, exclude_npc_id: Optional[str] = None) -> str:
         """
@@ -106,41 +287,62 @@ class ConversationStore:
         exclude_npc_id verilirse o NPC'nin konuşması hariç tutulur
         (zaten tam konuşması ayrıca gönderildiği için).
         """
-        with self._lock:
-            summaries = []
-            for npc_id, conv in self._conversations.items():
-                if npc_id == exclude_npc_id:
-                    continue
-                msg_count = len(conv["messages"])
-                if msg_count == 0:
-                    continue
-                # Son mesajı göster
-                last_msg = conv["messages"][-1]
-                summaries.append(
-                    f"[{npc_id}] {msg_count} mesaj, son: {last_msg['role']}: \"{last_msg['content'][:80]}...\""
-                )
-            if not summaries:
-                return ""
-            return "Diğer NPC konuşmaları:\n" + "\n".join(summaries)
+        # Son hesaplamadan beri hiçbir NPC'ye mesaj eklenmediyse aynı metni döndür
+        # (prompt prefix'i byte-byte aynı kalır)
+        with self._summary_lock:
+            seq = self._summary_seq
+            memo = self._context_memo.get(exclude_npc_id)
+        if memo is not None and memo[0] == seq:
+            return memo[1]
+
+        # Önbellekteki tuple'lar atomik olarak değiştirildiği için lock gerekmez
+        summaries = [
+            f"[{npc_id}] {msg_count} mesaj, son: {last_role}: \"{last_preview}...\""
+            for npc_id, (msg_count, last_role, last_preview) in list(self._summary_cache.items())
+            if npc_id != exclude_npc_id
+        ]
+        context = "Diğer NPC konuşmaları:\n" + "\n".join(summaries) if summaries else ""
+        # Hesaplama sırasında önbellek değiştiyse daha yeni bir memo ezilmesin
+        with self._summary_lock:
+            if self._summary_seq == seq:
+                self._context_memo[exclude_npc_id] = (seq, context)
+        return context
 
     # ─── Session / Chunk Management ─────────────────────────────────
 
     def add_chunk_text(self, session_id: str, index: int, text: str, stt_ms: float = 0.0) -> None:
         """
         Geçici session için chunk metni ve STT süresini ekler.
-        Thread-safe.
+        Thread-safe; bekleyen varsa session event'ini tetikler (event loop içinden çağrılmalı).
         """
-        with self._lock:
-            if session_id not in self._active_sessions:
-                self._active_sessions[session_id] = {}
-            self._active_sessions[session_id][index] = {
+        with self._lock_for(session_id):
+            chunks = self._active_sessions.get(session_id)
+            if chunks is None:
+                chunks = self._active_sessions.setdefault(session_id, {})
+            # Yaygın durum: chunk'lar sırayla gelir → dict sonuna eklemek yeterli
+            in_order = not chunks or index in chunks or index > next(reversed(chunks))
+            chunks[index] = {
                 "text": text,
                 "stt_ms": stt_ms
             }
-    
+            if not in_order:
+                # Sıra dışı geldi — dict'i index sırasına göre yeniden kur
+                self._active_sessions[session_id] = dict(sorted(chunks.items()))
+        event = self._chunk_events.get(session_id)
+        if event is not None:
+            event.set()
+
+    def get_chunk_event(self, session_id: str) -> asyncio.Event:
+        """Session'a yeni chunk eklendiğinde set edilen event'i döner (yoksa oluşturur).
+        finalize_session ile birlikte silinir."""
+        event = self._chunk_events.get(session_id)
+        if event is None:
+            event = self._chunk_events.setdefault(session_id, asyncio.Event())
+        return event
+
     def get_session_indices(self, session_id: str) -> list[int]:
-        """Mevcut session'daki chunk indexlerinin listesini döner."""
-        with self._lock:
+        """Mevcut session'daki chunk indexlerinin sıralı listesini döner."""
+        with self._lock_for(session_id):
             if session_id not in self._active_sessions:
                 return []
             return list(self._active_sessions[session_id].keys())
@@ -151,19 +353,18 @@ class ConversationStore:
         ve session'ı siler.
         Returns: (full_text, last_chunk_stt_ms)
         """
-        with self._lock:
+        self._chunk_events.pop(session_id, None)
+        with self._lock_for(session_id):
             chunks = self._active_sessions.pop(session_id, {})
             if not chunks:
                 return "", None
-            
-            # Index'e göre sırala
-            sorted_indices = sorted(chunks.keys())
-            sorted_texts = [chunks[i]["text"] for i in sorted_indices]
-            
+
+            # Chunk'lar zaten index sırasında — tekrar sıralamaya gerek yok
+            sorted_texts = [chunk["text"] for chunk in chunks.values()]
+
             # Son chunk'ın STT süresini bul
-            last_index = sorted_indices[-1]
-            last_stt_ms = chunks[last_index].get("stt_ms", 0.0)
-            
+            last_stt_ms = chunks[next(reversed(chunks))].get("stt_ms", 0.0)
+
             return " ".join(sorted_texts).strip(), last_stt_ms
 
 
@@ -7,9 +7,12 @@ Streaming modu: Gemini streamGenerateContent ile cümle bazlı streaming.
 import os
 import re
 import time
-import json as _json
+import asyncio
+import hashlib
 import logging
 import httpx
+import orjson
+from collections.abc import Mapping
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +20,8 @@ logger = logging.getLogger(__name__)
 LLM_MODEL = os.getenv("LLM_MODEL", "google/gemini-2.0-flash")
 LLM_SEED = int(os.getenv("LLM_SEED", "42"))
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.0"))
+# Prompt'a girecek konuşma geçmişinin tahmini token bütçesi
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "2000"))
 
 # --- Gemini API vs fal/OpenRouter seçimi ---
 USE_GEMINI_API = os.getenv("USE_GEMINI_API", "false").lower() == "true"
@@ -31,6 +36,10 @@ _AUTH_HEADERS_FAL = {
     "Content-Type": "application/json",
 }
 
+# Gövdeyi orjson ile kendimiz serialize ettiğimiz istekler için sabit header
+# (orjson doğrudan UTF-8 bytes üretir, Türkçe karakterleri escape etmez)
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
 # Gemini model haritası: OpenRouter formatını Gemini model adına çevirir
 _GEMINI_MODEL_MAP = {
     "google/gemini-2.5-flash": "gemini-2.5-flash",
@@ -55,6 +64,12 @@ STİL VE YANIT KURALLARI (KRİTİK):
 
 
 # Module-level persistent HTTP clients
+# Eşzamanlı NPC istekleri bağlantı beklemesin diye havuz geniş tutulur
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=50,
+    max_keepalive_connections=20,
+    keepalive_expiry=300,
+)
 _http_client: httpx.AsyncClient | None = None
 _gemini_client: httpx.AsyncClient | None = None
 
@@ -64,12 +79,9 @@ def _get_client() -> httpx.AsyncClient:
     global _http_client
     if _http_client is None or _http_client.is_closed:
         _http_client = httpx.AsyncClient(
-            timeout=60.0,
-            limits=httpx.Limits(
-                max_connections=5,
-                max_keepalive_connections=2,
-                keepalive_expiry=60,
-            ),
+            http2=True,  # Eşzamanlı istekler tek TLS bağlantısında multiplex edilir
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=_HTTP_LIMITS,
         )
     return _http_client
 
@@ -79,35 +91,195 @@ def _get_gemini_client() -> httpx.AsyncClient:
     global _gemini_client
     if _gemini_client is None or _gemini_client.is_closed:
         _gemini_client = httpx.AsyncClient(
-            timeout=60.0,
-            limits=httpx.Limits(
-                max_connections=5,
-                max_keepalive_connections=2,
-                keepalive_expiry=60,
-            ),
+            http2=True,  # Eşzamanlı streamGenerateContent'ler tek bağlantıda
+            # Key URL'de değil header'da — httpx hata mesajları URL'yi içerdiği
+            # için query string'deki key loglara sızardı
+            headers={"x-goog-api-key": GEMINI_API_KEY},
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=_HTTP_LIMITS,
         )
     return _gemini_client
 
+
+def init_http_clients() -> None:
+    """Aktif sağlayıcının client'ını startup'ta oluşturur (ilk istek beklemesin)."""
+    if USE_GEMINI_API:
+        _get_gemini_client()
+    else:
+        _get_client()
+
+
+async def close_http_clients() -> None:
+    """Shutdown'da açık bağlantıları kapatır."""
+    global _http_client, _gemini_client
+    for client in (_http_client, _gemini_client):
+        if client is not None:
+            await client.aclose()
+    _http_client = _gemini_client = None
+
+
+# ─── Gemini Context Cache ───────────────────────────────────────────
+# Açıkken sabit system prompt Gemini cachedContents'e bir kez yüklenir;
+# sonraki turlarda sadece cache adı gönderilir ve prefill tekrar ödenmez.
+# Anahtar system prompt'un hash'i olduğundan persona değişince yeni cache açılır.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+GEMINI_CACHE_TTL_S = int(os.getenv("GEMINI_CACHE_TTL_S", "3600"))
+_GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+# Cache süresi dolmadan bu kadar saniye önce yenisi açılır
+_CACHE_REFRESH_MARGIN_S = 60
+# Cache açılamayan prompt'lar bu süre boyunca tekrar denenmez
+_CACHE_RETRY_AFTER_S = 600
+# Gemini'nin context cache için kabul ettiği en küçük içerik (token). Tahmini
+# bunun altında kalan prompt'lar (özetleme, warmup) için cache hiç denenmez
+_CACHE_MIN_TOKENS = 1024
+# Cache'e referans veren istek bu kodlarla dönerse cache sunucuda silinmiş sayılır.
+# 400 sadece hata gövdesi cachedContent'i işaret ediyorsa sayılır (_is_cache_miss)
+_CACHE_MISS_STATUSES = (403, 404)
+
+# (gemini_model, system_prompt_hash) -> (cache_name | None, geçerlilik sonu [monotonic])
+_gemini_caches: dict[tuple[str, str], tuple[str | None, float]] = {}
+# Aynı anahtar için süren oluşturma görevi — farklı persona'lar birbirini beklemez
+_gemini_cache_inflight: dict[tuple[str, str], asyncio.Task] = {}
+
+
+def _gemini_cache_key(gemini_model: str, system_prompt: str) -> tuple[str, str]:
+    return gemini_model, hashlib.sha256(system_prompt.encode()).hexdigest()
+
+
+def _gemini_error_message(response: httpx.Response) -> str:
+    """Gemini hata gövdesinden sadece error.message'ı çıkarır (URL/key içermez)."""
+    try:
+        return orjson.loads(response.content).get("error", {}).get("message", "")
+    except (orjson.JSONDecodeError, AttributeError):
+        return ""
+
+
+async def _is_cache_miss(response: httpx.Response) -> bool:
+    """cachedContent referanslı istek, cache sunucuda yok olduğu için mi reddedildi?"""
+    if response.status_code in _CACHE_MISS_STATUSES:
+        return True
+    if response.status_code == 400:
+        await response.aread()
+        return b"cachedContent" in response.content
+    return False
+
+
+async def _get_gemini_cache_name(gemini_model: str, system_prompt: str) -> str | None:
+    """System prompt için geçerli cachedContents adını döner, yoksa oluşturur.
+    Oluşturulamazsa None döner (çağıran systemInstruction'a düşer)."""
+    if _estimate_tokens(system_prompt) < _CACHE_MIN_TOKENS:
+        return None
+    key = _gemini_cache_key(gemini_model, system_prompt)
+    entry = _gemini_caches.get(key)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0]
+
+    task = _gemini_cache_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_create_gemini_cache(key, gemini_model, system_prompt))
+        _gemini_cache_inflight[key] = task
+        task.add_done_callback(lambda _: _gemini_cache_inflight.pop(key, None))
+    # Bekleyenlerden biri iptal edilirse ortak oluşturma görevi sürsün
+    return await asyncio.shield(task)
+
+
+async def _create_gemini_cache(
+    key: tuple[str, str], gemini_model: str, system_prompt: str
+) -> str | None:
+    """cachedContents'i oluşturup sonucu _gemini_caches'e yazar."""
+    now = time.monotonic()
+    # Süresi geçmiş kayıtları (eski persona'lar dahil) temizle
+    for stale in [k for k, (_, expires) in _gemini_caches.items() if expires <= now]:
+        del _gemini_caches[stale]
+
+    try:
+        response = await _get_gemini_client().post(
+            f"{_GEMINI_BASE_URL}/cachedContents",
+            headers=_JSON_HEADERS,
+            content=orjson.dumps({
+                "model": f"models/{gemini_model}",
+                "systemInstruction": {"parts": [{"text": system_prompt}]},
+                "ttl": f"{GEMINI_CACHE_TTL_S}s",
+            }),
+        )
+        cache_name = None
+        if response.status_code == 200:
+            cache_name = orjson.loads(response.content).get("name")
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        # İstisna metni URL/istek içerebilir — sadece tipi loglanır
+        logger.warning(f"Gemini context cache oluşturulamadı ({type(e).__name__}), systemInstruction kullanılacak")
+        _gemini_caches[key] = (None, now + _CACHE_RETRY_AFTER_S)
+        return None
+    if not cache_name:
+        logger.warning(
+            f"Gemini context cache oluşturulamadı ({response.status_code}: "
+            f"{_gemini_error_message(response)}), systemInstruction kullanılacak"
+        )
+        _gemini_caches[key] = (None, now + _CACHE_RETRY_AFTER_S)
+        return None
+
+    _gemini_caches[key] = (cache_name, now + GEMINI_CACHE_TTL_S - _CACHE_REFRESH_MARGIN_S)
+    logger.info(f"Gemini context cache oluşturuldu: {cache_name} (ttl={GEMINI_CACHE_TTL_S}s)")
+    return cache_name
+
+
+async def _apply_system_prompt(gemini_payload: dict, gemini_model: str, system_prompt: str) -> bool:
+    """System prompt'u payload'a ekler: cache açıksa cachedContent referansı,
+    değilse systemInstruction olarak. Returns: cache kullanıldı mı"""
+    if not system_prompt:
+        return False
+    if GEMINI_CONTEXT_CACHE:
+        cache_name = await _get_gemini_cache_name(gemini_model, system_prompt)
+        if cache_name:
+            gemini_payload["cachedContent"] = cache_name
+            return True
+    gemini_payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    return False
+
+
+def _drop_gemini_cache(gemini_payload: dict, gemini_model: str, system_prompt: str) -> None:
+    """Geçersiz çıkan cache'i unutur ve payload'ı systemInstruction'a çevirir."""
+    logger.warning(f"Gemini context cache geçersiz: {gemini_payload.get('cachedContent')}")
+    _gemini_caches[_gemini_cache_key(gemini_model, system_prompt)] = (
+        None, time.monotonic() + _CACHE_RETRY_AFTER_S
+    )
+    gemini_payload.pop("cachedContent", None)
+    gemini_payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+
+
 if USE_GEMINI_API:
     logger.info(f"🔑 Gemini API modu aktif — model={LLM_MODEL}")
 else:
     logger.info(f"🌐 fal/OpenRouter modu aktif — model={LLM_MODEL}")
 
 
-def _build_prompt(
-    npc_config: dict,
-    conversation_history: list[dict],
-    user_message: str,
-    main_story: str = "",
-    cross_npc_context: str = "",
-) -> tuple[str, str]:
-    """LLM'e gönderilecek system_prompt ve user prompt'u oluşturur."""
-    # NPC bilgilerinden system prompt oluştur
-    npc_name = npc_config.get("name", "NPC")
+# (id(npc_config), main_story) -> (npc_config, system prompt). Registry NPC'leri
+# salt-okunur ve değişince yeni nesneyle değiştirildiği için nesne kimliği içerik
+# kimliği demektir; config referansı tutulduğundan id() başka nesneye geçemez
+_STATIC_SYSTEM_CACHE_SIZE = 256
+_static_system_cache: dict[tuple[int, str], tuple[Mapping, str]] = {}
+
+
+def _get_static_system(npc_config: Mapping, main_story: str) -> str:
+    """NPC config nesnesi ve ana hikaye aynı kaldıkça önbellekten döner."""
+    key = (id(npc_config), main_story)
+    entry = _static_system_cache.get(key)
+    if entry is not None and entry[0] is npc_config:
+        return entry[1]
+    full_system = _build_static_system(npc_config, main_story)
+    if len(_static_system_cache) >= _STATIC_SYSTEM_CACHE_SIZE:
+        # En eski kayıt (genelde registry'den çoktan düşmüş bir persona) atılır
+        del _static_system_cache[next(iter(_static_system_cache))]
+    _static_system_cache[key] = (npc_config, full_system)
+    return full_system
+
+
+def _build_static_system(npc_config: Mapping, main_story: str) -> str:
+    """NPC'nin turlar arasında değişmeyen system prompt'unu oluşturur."""
     personality = npc_config.get("personality", "")
     backstory = npc_config.get("backstory", "")
     system_prompt = npc_config.get("system_prompt", "")
-    actions = npc_config.get("actions", [])
+    actions = npc_config.get("actions", ())
 
     # System prompt'u zenginleştir
     full_system = f"{system_prompt}\n\n"
@@ -115,8 +287,8 @@ def _build_prompt(
         full_system += f"Kişiliğin: {personality}\n"
 
     # Knowledge Base / Lore
-    secrets = npc_config.get("secrets", [])
-    goals = npc_config.get("goals", [])
+    secrets = npc_config.get("secrets", ())
+    goals = npc_config.get("goals", ())
 
     if main_story:
         full_system += f"Oyunun Ana Hikayesi: {main_story}\n"
@@ -129,32 +301,157 @@ def _build_prompt(
 
     if actions:
         full_system += f"Yapabileceğin aksiyonlar: {', '.join(actions)}\n"
-    
+
     # Global kısıtlamaları ekle
     full_system += f"\n{GLOBAL_CONSTRAINTS}\n"
-    
-    # Cross-NPC context ekle (diğer NPC'lerle olan konuşmalar)
-    if cross_npc_context:
-        full_system += f"\n{cross_npc_context}\n"
+    return full_system
+
+
+def _estimate_tokens(text: str) -> int:
+    """Kaba token tahmini — Türkçe metinde ~3 karakter/token."""
+    return len(text) // 3
+
+
+def _trim_history(conversation_history: list[dict], budget: int = MAX_HISTORY_TOKENS) -> list[dict]:
+    """Geçmişi sondan başa doğru tarayıp token bütçesine sığan en yeni mesajları döner.
+    Bütçeyi aşan eski mesajlar prompt'a girmez. Baştaki özet (role=system)
+    mesajı her zaman korunur."""
+    head: list[dict] = []
+    if conversation_history and conversation_history[0]["role"] == "system":
+        head = conversation_history[:1]
+        budget -= _estimate_tokens(head[0]["content"])
+
+    used = 0
+    keep_from = len(conversation_history)
+    for i in range(len(conversation_history) - 1, len(head) - 1, -1):
+        used += _estimate_tokens(conversation_history[i]["content"])
+        if used > budget:
+            break
+        keep_from = i
+    if keep_from == len(head):
+        return conversation_history
+    return head + conversation_history[keep_from:]
+
+
+def _history_label(role: str, npc_name: str) -> str:
+    if role == "user":
+        return "Oyuncu"
+    if role == "system":
+        return "Önceki konuşmanın özeti"
+    return npc_name
+
+
+def _build_prompt(
+    npc_config: Mapping,
+    conversation_history: list[dict],
+    user_message: str,
+    main_story: str = "",
+    cross_npc_context: str = "",
+) -> tuple[str, str, list[dict]]:
+    """LLM'e gönderilecek system_prompt, user prompt ve Gemini contents'i oluşturur.
+
+    Prompt append-only kurulur: [sabit system] + [geçmiş] + [bu tur].
+    System prompt'a sadece NPC'nin sabit alanları girer; her turda değişen
+    cross-NPC özeti tura eklenir. Böylece provider'ın prompt-prefix cache'i
+    turlar arasında bozulmaz.
+
+    Returns: (system_prompt, full_prompt, gemini_contents)
+        full_prompt: geçmiş + bu tur, tek string (fal/OpenRouter için)
+        gemini_contents: geçmiş user/model turları + bu tur (Gemini için)
+    """
+    # NPC bilgilerinden system prompt oluştur (NPC başına önbellekli)
+    npc_name = npc_config.get("name", "NPC")
+    full_system = _get_static_system(npc_config, main_story)
+
+    # Uzun oturumlarda prompt sınırsız büyümesin — bütçeye sığan son mesajlar
+    conversation_history = _trim_history(conversation_history)
 
     # Konuşma geçmişini prompt'a ekle
     history_text = ""
     if conversation_history:
         history_text = "\nÖnceki konuşma:\n"
         for msg in conversation_history:
-            role_label = "Oyuncu" if msg["role"] == "user" else npc_name
+            role_label = _history_label(msg["role"], npc_name)
             history_text += f"{role_label}: {msg['content']}\n"
 
+    # Bu tur — cross-NPC context (diğer NPC'lerle olan konuşmalar) dinamik
+    # olduğu için system'a değil, geçmişin arkasına eklenir
+    turn_prompt = ""
+    if cross_npc_context:
+        turn_prompt += f"\n{cross_npc_context}\n"
+    turn_prompt += f"\nOyuncu: {user_message}\n(Hatırlatma: İlk cümlen en fazla 3 kelime olsun!)\n{npc_name}:"
+
     # Final prompt
-    full_prompt = f"{history_text}\nOyuncu: {user_message}\n(Hatırlatma: İlk cümlen en fazla 3 kelime olsun!)\n{npc_name}:"
+    full_prompt = f"{history_text}{turn_prompt}"
+    contents = _build_gemini_contents(conversation_history, turn_prompt.lstrip())
+
+    return full_system, full_prompt, contents
+
+
+# Geçmiş NPC'nin sözüyle başlıyorsa Gemini contents'inin başına konan user turu
+_GEMINI_OPENING_TURN = "(Oyuncu NPC'nin yanına geldi.)"
+
+
+def _build_gemini_contents(conversation_history: list[dict], turn_prompt: str) -> list[dict]:
+    """Geçmişi Gemini'nin user/model turlarına çevirir, sonuna bu turu ekler.
+    Ardışık aynı roldeki mesajlar tek turda birleştirilir; özet (role=system)
+    mesajı user turu olarak gönderilir."""
+    contents: list[dict] = []
+    for msg in conversation_history:
+        role = "model" if msg["role"] == "assistant" else "user"
+        text = msg["content"]
+        if msg["role"] == "system":
+            text = f"({_history_label('system', '')}: {text})"
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"][0]["text"] += f"\n{text}"
+        else:
+            contents.append({"role": role, "parts": [{"text": text}]})
+
+    # Gemini çok turlu konuşmanın user turuyla başlamasını bekler. /start_convo
+    # selamlaması (assistant) ya da _trim_history kesimi geçmişi model turuyla
+    # başlatabilir — öne kısa bir user turu konur
+    if contents and contents[0]["role"] == "model":
+        contents.insert(0, {"role": "user", "parts": [{"text": _GEMINI_OPENING_TURN}]})
 
-    return full_system, full_prompt
+    if contents and contents[-1]["role"] == "user":
+        contents[-1]["parts"][0]["text"] += f"\n{turn_prompt}"
+    else:
+        contents.append({"role": "user", "parts": [{"text": turn_prompt}]})
+    return contents
 
 
 _NOVOICE_RE = re.compile(r"<novoice>(.*?)</novoice>", re.IGNORECASE | re.DOTALL)
+# novoice içeriğindeki "anahtar: değer" alanları ("|" ile ayrılmış)
+_NOVOICE_FIELD_RE = re.compile(r"(\w+)\s*:\s*([^|]*)")
+
+_NS_PER_MS = 1_000_000
+
+# Bu uzunluğun altındaki cümleler bir sonrakiyle birleştirilip öyle yield edilir
+MIN_YIELD_CHARS = 12
+
+_NOVOICE_OPEN = "<novoice>"
+# Yarım gelmiş tag'i kaçırmamak için buffer sonundan tekrar taranan karakter sayısı
+_NOVOICE_OVERLAP = len(_NOVOICE_OPEN) - 1
+_NOVOICE_CLOSE = "</novoice>"
+_NOVOICE_CLOSE_OVERLAP = len(_NOVOICE_CLOSE) - 1
 
 # Cümle sonu: . ! ? … karakterinden sonra boşluk geldiğinde böl
-_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])\s+')
+_SENTENCE_END_RE = re.compile(r'[.!?…]\s+')
+
+
+def _to_number(value: str):
+    """Sayıya çevrilebiliyorsa int/float, değilse olduğu gibi döner."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+# novoice alanlarına özel tip dönüşümleri
+_NOVOICE_COERCE = {"price": _to_number}
 
 
 def _parse_novoice(text: str) -> tuple[dict, str]:
@@ -168,40 +465,80 @@ def _parse_novoice(text: str) -> tuple[dict, str]:
     if not match:
         return {}, text.strip()
 
-    novoice_content = match.group(1).strip()
-    clean_text = _NOVOICE_RE.sub("", text).strip()
+    # Tag'i bulunan span'den kes — ikinci bir regex taraması yapma
+    start, end = match.span()
+    clean_text = (text[:start] + text[end:]).strip()
 
     metadata = {}
-    parts = novoice_content.split("|")
-    for part in parts:
-        part = part.strip()
-        if ":" in part:
-            key, value = part.split(":", 1)
-            key = key.strip().lower()
-            value = value.strip()
-            if key == "price":
-                try:
-                    value = int(value)
-                except ValueError:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-            metadata[key] = value
+    for key, value in _NOVOICE_FIELD_RE.findall(match.group(1)):
+        key = key.lower()
+        value = value.strip()
+        coerce = _NOVOICE_COERCE.get(key)
+        metadata[key] = coerce(value) if coerce else value
 
     return metadata, clean_text
 
 
-def _split_buffer(buffer: str) -> tuple[list[str], str]:
+def _split_buffer(buffer: str, scan_pos: int = 0) -> tuple[list[str], str, int]:
     """Buffer'ı cümle sınırlarından böler.
-    Returns: (tamamlanmış_cümleler, kalan_buffer)
+    Sadece scan_pos'tan sonrası taranır — önceki delta'larda bakılmış
+    kısım tekrar taranmaz (streaming'de toplam O(N)).
+    Returns: (tamamlanmış_cümleler, kalan_buffer, kalan_buffer_için_scan_pos)
+    """
+    sentences = []
+    start = 0
+    match = _SENTENCE_END_RE.search(buffer, scan_pos)
+    while match:
+        sentence = buffer[start:match.start() + 1].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+        match = _SENTENCE_END_RE.search(buffer, start)
+
+    remaining = buffer[start:] if start else buffer
+    # Son karakter cümle sonu olabilir; arkasından boşluk gelirse tekrar bakılmalı
+    return sentences, remaining, max(len(remaining) - 1, 0)
+
+
+def _coalesce_sentences(sentences: list[str], pending: str,
+                        emitted_any: bool) -> tuple[list[str], str]:
+    """Kısa cümleleri MIN_YIELD_CHARS'a ulaşana kadar birleştirir
+    (her cümle ayrı TTS isteği olmasın diye).
+    İlk cümle bekletilmez — ilk sesin gecikmemesi için hemen yield edilir.
+    Returns: (yield_edilecekler, bekleyen)"""
+    ready = []
+    for sentence in sentences:
+        pending = f"{pending} {sentence}" if pending else sentence
+        if (emitted_any or ready) and len(pending) < MIN_YIELD_CHARS:
+            continue
+        ready.append(pending)
+        pending = ""
+    return ready, pending
+
+
+_SSE_DATA_PREFIX = b"data: "
+_SSE_DATA_LEN = len(_SSE_DATA_PREFIX)
+
+
+async def _iter_sse_data(response: httpx.Response):
     """
-    parts = _SENTENCE_SPLIT_RE.split(buffer)
-    if len(parts) <= 1:
-        return [], buffer  # Henüz tamamlanmış cümle yok
-    # Son parça hariç hepsi tamamlanmış cümle
-    sentences = [p.strip() for p in parts[:-1] if p.strip()]
-    return sentences, parts[-1]
+    SSE yanıtındaki 'data: ' satırlarının payload'ını bytes olarak yield eder.
+    Ham byte akışı üzerinde çalışır — satır başına str decode yapılmaz,
+    orjson bytes'ı doğrudan parse eder.
+    """
+    buf = bytearray()
+    async for chunk in response.aiter_bytes(chunk_size=4096):
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            if buf.startswith(_SSE_DATA_PREFIX, start):
+                yield bytes(buf[start + _SSE_DATA_LEN:nl]).rstrip(b"\r")
+            start = nl + 1
+        # İşlenen satırları tek seferde at
+        del buf[:start]
+    # Sonda newline'sız kalan son satır
+    if buf.startswith(_SSE_DATA_PREFIX):
+        yield bytes(buf[_SSE_DATA_LEN:]).rstrip(b"\r")
 
 
 async def _stream_gemini_deltas(payload: dict):
@@ -211,11 +548,12 @@ async def _stream_gemini_deltas(payload: dict):
 
     system_prompt = payload.get("system_prompt", "")
     user_prompt = payload.get("prompt", "")
+    contents = payload.get("contents") or [
+        {"role": "user", "parts": [{"text": user_prompt}]}
+    ]
 
     gemini_payload = {
-        "contents": [
-            {"role": "user", "parts": [{"text": user_prompt}]}
-        ],
+        "contents": contents,
         "generationConfig": {
             "temperature": payload.get("temperature", LLM_TEMPERATURE),
             "maxOutputTokens": payload.get("max_tokens", 300),
@@ -223,45 +561,49 @@ async def _stream_gemini_deltas(payload: dict):
         },
     }
 
-    if system_prompt:
-        gemini_payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    use_cache = await _apply_system_prompt(gemini_payload, gemini_model, system_prompt)
     if LLM_SEED > 0:
         gemini_payload["generationConfig"]["seed"] = LLM_SEED
 
     url = (
-        f"https://generativelanguage.googleapis.com/v1beta/models/"
-        f"{gemini_model}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+        f"{_GEMINI_BASE_URL}/models/"
+        f"{gemini_model}:streamGenerateContent?alt=sse"
     )
 
     client = _get_gemini_client()
-    async with client.stream(
-        "POST", url,
-        json=gemini_payload,
-        headers={"Content-Type": "application/json"},
-    ) as response:
-        response.raise_for_status()
-        async for line in response.aiter_lines():
-            if not line.startswith("data: "):
-                continue
-            try:
-                data = _json.loads(line[6:])
-            except (ValueError, _json.JSONDecodeError):
-                continue
-            candidates = data.get("candidates", [])
-            if not candidates:
+    while True:
+        async with client.stream(
+            "POST", url,
+            content=orjson.dumps(gemini_payload),
+            headers=_JSON_HEADERS,
+        ) as response:
+            if use_cache and await _is_cache_miss(response):
+                # Cache sunucuda düşmüş olabilir — bir kez systemInstruction ile dene
+                _drop_gemini_cache(gemini_payload, gemini_model, system_prompt)
+                use_cache = False
                 continue
-            parts = candidates[0].get("content", {}).get("parts", [])
-            if parts:
-                text = parts[0].get("text", "")
-                if text:
-                    yield text
-
+            response.raise_for_status()
+            async for frame in _iter_sse_data(response):
+                try:
+                    data = orjson.loads(frame)
+                except orjson.JSONDecodeError:
+                    continue
+                candidates = data.get("candidates", [])
+                if not candidates:
+                    continue
+                parts = candidates[0].get("content", {}).get("parts", [])
+                if parts:
+                    text = parts[0].get("text", "")
+                    if text:
+                        yield text
+        return
 
 async def _stream_llm_sentences(
     system_prompt: str,
     user_prompt: str,
     temperature: float = LLM_TEMPERATURE,
     max_tokens: int = 400,
+    contents: list[dict] | None = None,
 ):
     """
     LLM streaming → cümle bazlı async generator.
@@ -272,7 +614,8 @@ async def _stream_llm_sentences(
         ...
         {"type": "done", "full_text": "...", "novoice": {...}, "llm_time_ms": 123.4}
     """
-    start_time = time.perf_counter()
+    # Zamanlar int nanosaniye olarak tutulur, ms'e sadece raporlarken çevrilir
+    start_ns = time.perf_counter_ns()
 
     if not USE_GEMINI_API:
         # Fallback: non-streaming — tek seferde al, tek cümle olarak yield et
@@ -284,7 +627,7 @@ async def _stream_llm_sentences(
             "max_tokens": max_tokens,
             "reasoning": False,
         })
-        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        elapsed_ms = (time.perf_counter_ns() - start_ns) / _NS_PER_MS
         raw_text = result.get("output", "").strip()
         novoice_meta, clean_text = _parse_novoice(raw_text)
         if not clean_text:
@@ -298,15 +641,22 @@ async def _stream_llm_sentences(
 
     # ── Gemini Streaming ──
     buffer = ""
-    full_text = ""
+    scan_pos = 0  # buffer'ın cümle sonu için taranmamış kısmının başı
+    novoice_scan_pos = 0  # buffer'ın <novoice> için taranmamış kısmının başı
+    # Metin parçaları listede biriktirilir, sonda tek "".join ile birleştirilir
+    # (str += her delta'da tüm metni kopyalar)
+    full_text_parts: list[str] = []
     sentence_index = 0
     novoice_buffer = ""
+    novoice_meta = None  # kapanış tag'i görüldüğü anda parse edilir
     in_novoice = False
-    first_sentence_ms = None
+    pending = ""  # henüz yield edilmemiş kısa cümle(ler)
+    first_sentence_ns = 0  # 0 → henüz cümle yield edilmedi
 
     payload = {
         "prompt": user_prompt,
         "system_prompt": system_prompt,
+        "contents": contents,
         "model": LLM_MODEL,
         "temperature": temperature,
         "max_tokens": max_tokens,
@@ -314,82 +664,91 @@ async def _stream_llm_sentences(
 
     try:
         async for delta in _stream_gemini_deltas(payload):
-            # novoice modundaysa sadece novoice buffer'a ekle
+            # novoice modundaysa sadece novoice buffer'a ekle; kapanış tag'i
+            # gelince hemen parse et — stream bittiğinde iş kalmasın
             if in_novoice:
-                novoice_buffer += delta
+                if novoice_meta is None:
+                    close_scan = max(len(novoice_buffer) - _NOVOICE_CLOSE_OVERLAP, 0)
+                    novoice_buffer += delta
+                    if _NOVOICE_CLOSE in novoice_buffer[close_scan:].lower():
+                        novoice_meta, _ = _parse_novoice(novoice_buffer)
                 continue
 
             buffer += delta
 
-            # <novoice> tag'i başladı mı?
-            if "<novoice>" in buffer:
-                idx = buffer.index("<novoice>")
+            # <novoice> tag'i başladı mı? (sadece yeni gelen kısma bakılır)
+            idx = buffer.find(_NOVOICE_OPEN, novoice_scan_pos)
+            if idx >= 0:
                 before = buffer[:idx]
                 novoice_buffer = buffer[idx:]
                 buffer = ""
                 in_novoice = True
-
-                # novoice öncesi kalan metni işle
-                if before.strip():
-                    sents, remaining = _split_buffer(before)
-                    for s in sents:
-                        if s.strip():
-                            full_text += s + " "
-                            if first_sentence_ms is None:
-                                first_sentence_ms = (time.perf_counter() - start_time) * 1000
-                            yield {"type": "sentence", "text": s.strip(), "index": sentence_index}
-                            sentence_index += 1
-                    if remaining.strip():
-                        full_text += remaining + " "
-                        if first_sentence_ms is None:
-                            first_sentence_ms = (time.perf_counter() - start_time) * 1000
-                        yield {"type": "sentence", "text": remaining.strip(), "index": sentence_index}
-                        sentence_index += 1
+                if _NOVOICE_CLOSE in novoice_buffer.lower():
+                    novoice_meta, _ = _parse_novoice(novoice_buffer)
+
+                # novoice öncesi kalan metni işle — kalan kısım da son cümledir
+                sentences, remaining, _ = _split_buffer(before)
+                if remaining.strip():
+                    sentences.append(remaining.strip())
+            else:
+                # Normal cümle bölme
+                sentences, buffer, scan_pos = _split_buffer(buffer, scan_pos)
+                novoice_scan_pos = max(len(buffer) - _NOVOICE_OVERLAP, 0)
+
+            if not sentences:
                 continue
-
-            # Normal cümle bölme
-            sentences, buffer = _split_buffer(buffer)
-            for s in sentences:
-                if s.strip():
-                    full_text += s + " "
-                    if first_sentence_ms is None:
-                        first_sentence_ms = (time.perf_counter() - start_time) * 1000
-                        logger.info(f"LLM ilk cümle: {first_sentence_ms:.0f}ms — \"{s[:60]}\"")
-                    yield {"type": "sentence", "text": s.strip(), "index": sentence_index}
-                    sentence_index += 1
+            full_text_parts.extend(sentences)
+            ready, pending = _coalesce_sentences(sentences, pending, sentence_index > 0)
+            if in_novoice and pending:
+                # Sesli metin bitti — bekleyen kısa cümleyi de hemen gönder
+                ready.append(pending)
+                pending = ""
+
+            for text in ready:
+                if not first_sentence_ns:
+                    first_sentence_ns = time.perf_counter_ns()
+                    logger.info(f"LLM ilk cümle: {(first_sentence_ns - start_ns) / _NS_PER_MS:.0f}ms"
+                                f" — \"{text[:60]}\"")
+                yield {"type": "sentence", "text": text, "index": sentence_index}
+                sentence_index += 1
 
     except Exception as e:
         logger.error(f"LLM streaming hatası: {e}")
         raise RuntimeError(f"LLM streaming yanıt üretemedi: {e}")
 
-    # Kalan buffer'ı son cümle olarak yield et
-    if buffer.strip() and not in_novoice:
-        full_text += buffer
-        if first_sentence_ms is None:
-            first_sentence_ms = (time.perf_counter() - start_time) * 1000
-        yield {"type": "sentence", "text": buffer.strip(), "index": sentence_index}
+    # Kalan buffer'ı (ve bekleyen kısa cümleleri) son cümle olarak yield et
+    tail = "" if in_novoice else buffer.strip()
+    if tail:
+        full_text_parts.append(tail)
+        pending = f"{pending} {tail}" if pending else tail
+    if pending:
+        if not first_sentence_ns:
+            first_sentence_ns = time.perf_counter_ns()
+        yield {"type": "sentence", "text": pending, "index": sentence_index}
         sentence_index += 1
 
-    elapsed_ms = (time.perf_counter() - start_time) * 1000
-    clean_text = full_text.strip()
+    end_ns = time.perf_counter_ns()
+    elapsed_ms = (end_ns - start_ns) / _NS_PER_MS
+    first_sentence_ms = (first_sentence_ns - start_ns) / _NS_PER_MS if first_sentence_ns else None
+    clean_text = " ".join(full_text_parts).strip()
 
-    # novoice parse
-    novoice_meta = {}
-    if novoice_buffer:
-        novoice_meta, _ = _parse_novoice(novoice_buffer)
+    # novoice stream sırasında kapanmadıysa (ör. token limiti) son bir deneme
+    if novoice_meta is None:
+        novoice_meta = _parse_novoice(novoice_buffer)[0] if novoice_buffer else {}
 
     if not clean_text:
         clean_text = "Hmm, bir şey söyleyemedim."
 
+    first_sentence_log = f"{first_sentence_ms:.0f}ms" if first_sentence_ms is not None else "-"
     logger.info(f"LLM streaming tamamlandı: {elapsed_ms:.0f}ms, "
-                f"{sentence_index} cümle, ilk cümle: {first_sentence_ms:.0f}ms")
+                f"{sentence_index} cümle, ilk cümle: {first_sentence_log}")
 
     yield {
         "type": "done",
         "full_text": clean_text,
         "novoice": novoice_meta,
         "llm_time_ms": round(elapsed_ms, 1),
-        "first_sentence_ms": round(first_sentence_ms, 1) if first_sentence_ms else None,
+        "first_sentence_ms": round(first_sentence_ms, 1) if first_sentence_ms is not None else None,
         "sentence_count": sentence_index,
     }
 
@@ -403,13 +762,17 @@ async def _call_llm(payload: dict) -> dict:
 
 async def _call_fal(payload: dict) -> dict:
     """fal.ai/OpenRouter üzerinden LLM çağrısı."""
+    # Gemini'ye özel çok turlu contents OpenRouter'a gönderilmez
+    payload.pop("contents", None)
     if LLM_SEED > 0:
         payload["seed"] = LLM_SEED
 
     client = _get_client()
-    response = await client.post(LLM_ENDPOINT, headers=_AUTH_HEADERS_FAL, json=payload)
+    response = await client.post(
+        LLM_ENDPOINT, headers=_AUTH_HEADERS_FAL, content=orjson.dumps(payload)
+    )
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
 async def _call_gemini(payload: dict) -> dict:
@@ -424,14 +787,16 @@ async def _call_gemini(payload: dict) -> dict:
     # Prompt ve system_prompt'ı Gemini contents formatına çevir
     system_prompt = payload.get("system_prompt", "")
     user_prompt = payload.get("prompt", "")
+    # Çok turlu contents verilmişse onu kullan (prompt-prefix cache dostu)
+    contents = payload.get("contents") or [
+        {
+            "role": "user",
+            "parts": [{"text": user_prompt}]
+        }
+    ]
     
     gemini_payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": user_prompt}]
-            }
-        ],
+        "contents": contents,
         "generationConfig": {
             "temperature": payload.get("temperature", LLM_TEMPERATURE),
             "maxOutputTokens": payload.get("max_tokens", 300),
@@ -441,26 +806,31 @@ async def _call_gemini(payload: dict) -> dict:
         }
     }
     
-    # System instruction ekle
-    if system_prompt:
-        gemini_payload["systemInstruction"] = {
-            "parts": [{"text": system_prompt}]
-        }
+    # System instruction ekle (context cache açıksa cache referansı olarak)
+    use_cache = await _apply_system_prompt(gemini_payload, gemini_model, system_prompt)
     
     # Seed ekle (destekleniyorsa)
     if LLM_SEED > 0:
         gemini_payload["generationConfig"]["seed"] = LLM_SEED
     
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{gemini_model}:generateContent?key={GEMINI_API_KEY}"
+    url = f"{_GEMINI_BASE_URL}/models/{gemini_model}:generateContent"
     
     client = _get_gemini_client()
     response = await client.post(
         url,
-        headers={"Content-Type": "application/json"},
-        json=gemini_payload
+        headers=_JSON_HEADERS,
+        content=orjson.dumps(gemini_payload)
     )
+    if use_cache and await _is_cache_miss(response):
+        # Cache sunucuda düşmüş olabilir — bir kez systemInstruction ile dene
+        _drop_gemini_cache(gemini_payload, gemini_model, system_prompt)
+        response = await client.post(
+            url,
+            headers=_JSON_HEADERS,
+            content=orjson.dumps(gemini_payload)
+        )
     response.raise_for_status()
-    gemini_result = response.json()
+    gemini_result = orjson.loads(response.content)
     
     # Gemini yanıtını fal/OpenRouter formatına dönüştür (gerisi değişmesin)
     output_text = ""
@@ -486,8 +856,34 @@ async def _call_gemini(payload: dict) -> dict:
     }
 
 
+async def summarize_history(previous_summary: str, messages: list[dict]) -> str:
+    """Önceki özet ile hafızadan düşen mesajları birleştirip yeni kısa bir özet üretir.
+    ConversationStore'un summary katmanını güncellemek için kullanılır."""
+    lines = "\n".join(
+        f"{_history_label(msg['role'], 'NPC')}: {msg['content']}" for msg in messages
+    )
+    prompt = ""
+    if previous_summary:
+        prompt += f"Mevcut özet:\n{previous_summary}\n\n"
+    prompt += f"Yeni mesajlar:\n{lines}\n\nGüncellenmiş özet:"
+
+    result = await _call_llm({
+        "model": LLM_MODEL,
+        "prompt": prompt,
+        "system_prompt": (
+            "Bir oyuncu ile NPC arasındaki konuşmanın özetini tutuyorsun. "
+            "Mevcut özete yeni mesajları ekleyerek en fazla 5 cümlelik, "
+            "fiyatlar, anlaşmalar ve önemli bilgileri koruyan tek bir özet yaz."
+        ),
+        "temperature": 0.0,
+        "max_tokens": 200,
+        "reasoning": False,
+    })
+    return result.get("output", "").strip()
+
+
 async def generate_response(
-    npc_config: dict,
+    npc_config: Mapping,
     conversation_history: list[dict],
     user_message: str,
     main_story: str = "",
@@ -496,7 +892,7 @@ async def generate_response(
     max_tokens: int = 400,
 ) -> dict:
     """NPC yanıtı üretir (Direct HTTP + Pooling). Non-streaming endpoint'ler için."""
-    system_prompt, full_prompt = _build_prompt(
+    system_prompt, full_prompt, contents = _build_prompt(
         npc_config, conversation_history, user_message, main_story, cross_npc_context
     )
 
@@ -507,6 +903,7 @@ async def generate_response(
         result = await _call_llm({
             "prompt": full_prompt,
             "system_prompt": system_prompt,
+            "contents": contents,
             "model": LLM_MODEL,
             "temperature": temperature,
             "max_tokens": max_tokens,
@@ -534,7 +931,7 @@ async def generate_response(
 
 
 async def generate_response_stream(
-    npc_config: dict,
+    npc_config: Mapping,
     conversation_history: list[dict],
     user_message: str,
     main_story: str = "",
@@ -546,17 +943,19 @@ async def generate_response_stream(
     NPC yanıtını streaming olarak üretir — cümle bazlı async generator.
     Her cümle yield edildiğinde hemen TTS'e gönderilebilir.
     """
-    system_prompt, full_prompt = _build_prompt(
+    system_prompt, full_prompt, contents = _build_prompt(
         npc_config, conversation_history, user_message, main_story, cross_npc_context
     )
     logger.info(f"LLM streaming isteği — model={LLM_MODEL}, geçmiş={len(conversation_history)} mesaj")
 
-    async for item in _stream_llm_sentences(system_prompt, full_prompt, temperature, max_tokens):
+    async for item in _stream_llm_sentences(
+        system_prompt, full_prompt, temperature, max_tokens, contents=contents
+    ):
         yield item
 
 
 async def generate_starter_response(
-    npc_config: dict,
+    npc_config: Mapping,
     instruction: str,
     main_story: str = "",
     temperature: float = LLM_TEMPERATURE,
@@ -614,7 +1013,7 @@ async def generate_starter_response(
 
 
 async def generate_starter_response_stream(
-    npc_config: dict,
+    npc_config: Mapping,
     instruction: str,
     main_story: str = "",
     temperature: float = LLM_TEMPERATURE,
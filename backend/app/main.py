@@ -5,31 +5,46 @@ STT → LLM → TTS pipeline'ı ile NPC yanıtını sese çevirip döner.
 """
 
 import os
+import re
+import sys
 import time
-import json
 import asyncio
+import hashlib
 import logging
-import queue as thread_queue
+import functools
+from collections import OrderedDict
 from pathlib import Path
-from urllib.parse import quote
+from urllib.parse import quote_from_bytes
 
+import orjson
 from dotenv import load_dotenv
 
 # .env dosyasını yükle (FAL_KEY vb.)
 load_dotenv()
 
+from anyio import to_thread as anyio_to_thread
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
-from app.conversation_store import store
+from app.conversation_store import store, CONVERSATION_PAGE_LIMIT
 from app.npc_registry import registry
-from app.stt_service import transcribe_audio
-from app.tts_service import text_to_speech_wav, text_to_speech_stream, SAMPLE_RATE
+from app.stt_service import (
+    transcribe_audio,
+    init_http_client as init_stt_client,
+    close_http_client as close_stt_client,
+)
+from app.tts_service import (
+    text_to_speech_wav, text_to_speech_stream_async, SAMPLE_RATE,
+    shutdown_executor as shutdown_tts_executor,
+)
 from app.llm_service import (
     generate_response, generate_starter_response,
     generate_response_stream, generate_starter_response_stream,
+    summarize_history, LLM_TEMPERATURE,
+    init_http_clients as init_llm_clients,
+    close_http_clients as close_llm_clients,
 )
 
 # ─── Modeller ──────────────────────────────────────────────────
@@ -53,11 +68,19 @@ logger = logging.getLogger("atom-voice")
 # Debug logging flag — .env'den okunur, prod'da false yapılır
 DEBUG_LOGGING = os.getenv("DEBUG_LOGGING", "true").lower() in ("true", "1", "yes")
 
+# Startup'ta STT'ye paralel atılan warmup isteği sayısı (≈ ısıtılan replica sayısı)
+STT_WARMUP_CALLS = int(os.getenv("STT_WARMUP_CALLS", "2"))
 
-def debug_print(msg: str) -> None:
-    """DEBUG_LOGGING açıksa print eder, kapalıysa hiçbir şey yapmaz."""
-    if DEBUG_LOGGING:
-        print(msg)
+# /start_convo yanıt önbelleği (LLM metni + TTS WAV) — 0 ise kapalı.
+# Sadece LLM_TEMPERATURE=0 iken devrede: yanıt deterministikse tekrar üretmeye gerek yok
+START_CONVO_CACHE_SIZE = int(os.getenv("START_CONVO_CACHE_SIZE", "256"))
+
+# Starlette'in threadpool'u (UploadFile okuma, sync bağımlılıklar) için anyio
+# token sayısı — varsayılan 40 yük altında dar kalabiliyor
+THREADPOOL_TOKENS = int(os.getenv("THREADPOOL_TOKENS", "100"))
+
+# /health için — servisler de key'i import sırasında bir kez okuyor
+_FAL_KEY_CONFIGURED = bool(os.getenv("FAL_KEY"))
 
 
 def _log_pipeline(endpoint: str, *, stt_ms=None, final_chunk_stt_ms=None, llm_ms=0,
@@ -67,37 +90,69 @@ def _log_pipeline(endpoint: str, *, stt_ms=None, final_chunk_stt_ms=None, llm_ms
                   chunks=None, user_text="", npc_text="",
                   action="", price=0, mood="", note=""):
     """Pipeline özet log'ı — tüm endpoint'ler için ortak."""
-    debug_print(f"\n🏁" + "─" * 68)
-    debug_print(f"✅ {endpoint}")
-    debug_print("─" * 70)
+    if not DEBUG_LOGGING:
+        return  # Satırların hiçbiri formatlanmaz
+    lines: list[str] = []
+    lines.append(f"\n🏁" + "─" * 68)
+    lines.append(f"✅ {endpoint}")
+    lines.append("─" * 70)
     if stt_ms is not None:
-        debug_print(f"   🎙️  STT Total:      {stt_ms:7.1f} ms")
+        lines.append(f"   🎙️  STT Total:      {stt_ms:7.1f} ms")
     if final_chunk_stt_ms is not None:
-        debug_print(f"   🎙️  STT Final Chunk:{final_chunk_stt_ms:7.1f} ms")
-    debug_print(f"   🧠  LLM toplam:     {llm_ms:7.1f} ms")
+        lines.append(f"   🎙️  STT Final Chunk:{final_chunk_stt_ms:7.1f} ms")
+    lines.append(f"   🧠  LLM toplam:     {llm_ms:7.1f} ms")
     if llm_first_sentence_ms is not None:
-        debug_print(f"   🧠  LLM ilk cümle:  {llm_first_sentence_ms:7.1f} ms")
+        lines.append(f"   🧠  LLM ilk cümle:  {llm_first_sentence_ms:7.1f} ms")
     if sentence_count is not None:
-        debug_print(f"   📝  Cümle sayısı:   {sentence_count:7}")
+        lines.append(f"   📝  Cümle sayısı:   {sentence_count:7}")
     if tts_first_chunk_ms is not None:
-        debug_print(f"   🔊  TTS ilk chunk:  {tts_first_chunk_ms:7.1f} ms")
-    debug_print(f"   🔊  TTS toplam:     {tts_total_ms:7.1f} ms")
+        lines.append(f"   🔊  TTS ilk chunk:  {tts_first_chunk_ms:7.1f} ms")
+    lines.append(f"   🔊  TTS toplam:     {tts_total_ms:7.1f} ms")
     fa = first_audio_ms if first_audio_ms else total_ms
-    debug_print(f"   ⚡  İLK SES:        {fa:7.1f} ms  ← kullanıcının duyduğu")
-    debug_print(f"   ⌛  TOPLAM:         {total_ms:7.1f} ms")
+    lines.append(f"   ⚡  İLK SES:        {fa:7.1f} ms  ← kullanıcının duyduğu")
+    lines.append(f"   ⌛  TOPLAM:         {total_ms:7.1f} ms")
     if chunks is not None:
-        debug_print(f"   📦  Chunks:         {chunks:7}")
-    debug_print("─" * 70)
+        lines.append(f"   📦  Chunks:         {chunks:7}")
+    lines.append("─" * 70)
     if user_text:
-        debug_print(f"   👤 \"{user_text}\"")
-    debug_print(f"   🤖 \"{npc_text}\"")
+        lines.append(f"   👤 \"{user_text}\"")
+    lines.append(f"   🤖 \"{npc_text}\"")
     if action or price or mood or note:
-        debug_print("─" * 70)
-        debug_print(f"   🎬  Action:    {action}")
-        debug_print(f"   💰  Price:     {price}")
-        debug_print(f"   😊  Mood:      {mood}")
-        debug_print(f"   📝  Note:      {note}")
-    debug_print("─" * 70 + "\n")
+        lines.append("─" * 70)
+        lines.append(f"   🎬  Action:    {action}")
+        lines.append(f"   💰  Price:     {price}")
+        lines.append(f"   😊  Mood:      {mood}")
+        lines.append(f"   📝  Note:      {note}")
+    lines.append("─" * 70 + "\n")
+    # Tek write + flush — satır başına ayrı syscall yok (unbuffered stdout)
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+
+# Arka plan task'larına referans tut — yoksa GC tarafından toplanabilirler
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn_background(coro) -> None:
+    """Coroutine'i yanıtı bekletmeden arka planda çalıştırır."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _log_pipeline_safe(endpoint: str, **kwargs) -> None:
+    """_log_pipeline'ı worker thread'de çalıştırır; log hatası yanıtı etkilemez."""
+    try:
+        await asyncio.to_thread(_log_pipeline, endpoint, **kwargs)
+    except Exception as e:
+        logger.warning(f"Pipeline log yazılamadı: {e}")
+
+
+def _log_pipeline_background(endpoint: str, **kwargs) -> None:
+    """Pipeline log'unu arka plana atar — stream log yüzünden geç kapanmaz."""
+    if DEBUG_LOGGING:
+        _spawn_background(_log_pipeline_safe(endpoint, **kwargs))
+
 
 # FastAPI uygulaması
 app = FastAPI(
@@ -106,6 +161,13 @@ app = FastAPI(
     version="0.2.0",
 )
 
+# Client'ın (Godot web build dahil) okuyabilmesi gereken özel response header'ları
+_EXPOSED_HEADERS = [
+    "X-NPC-Id", "X-NPC-Response-Text", "X-NPC-Action", "X-NPC-Price",
+    "X-NPC-Mood", "X-NPC-Note", "X-User-Text", "X-Pipeline-Time-Ms",
+    "X-STT-Time-Ms", "X-LLM-Time-Ms", "X-TTS-Time-Ms",
+]
+
 # CORS — Godot HTTP istekleri için
 app.add_middleware(
     CORSMiddleware,
@@ -113,9 +175,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=_EXPOSED_HEADERS,
 )
 
 
+def _quote_header(text: str, safe: str = "") -> str:
+    """Türkçe metni HTTP header'ına konabilecek şekilde percent-encode eder."""
+    return quote_from_bytes(text.encode("utf-8"), safe=safe)
+
+
+@functools.lru_cache(maxsize=1024)
+def _qnote(note: str) -> str:
+    """novoice 'note' alanı turlar arasında sık tekrarlandığı için encode'u önbelleklenir."""
+    return _quote_header(note)
+
+
 # ─── Başlangıç: NPC'leri yükle ─────────────────────────────────
 
 @app.on_event("startup")
@@ -125,6 +199,25 @@ async def startup_event():
     1. NPC'leri yükler
     2. STT/LLM/TTS servislerini ısıtır (cold-start yok etmek için)
     """
+    anyio_to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_TOKENS
+
+    # Dosya kontrolü + JSON okuma thread'de — event loop bloklanmaz
+    await asyncio.to_thread(_load_registry)
+
+    # ── Kalıcı HTTP client'lar — warmup istekleri aynı havuzu ısıtır ──
+    init_stt_client()
+    init_llm_clients()
+
+    # ── Pipeline Warmup (sunucu warmup bitene kadar istek almaz) ──
+    await _warmup_pipeline()
+
+    # ── Keep-alive ping iptal edildi (istek üzerine) ──
+    # asyncio.create_task(_keep_alive_loop())
+
+
+def _load_registry() -> None:
+    """knowledgebase.json varsa onu, yoksa varsayılan npcs.json'u yükler.
+    Senkron dosya IO içerdiği için thread'de çalıştırılır."""
     kb_path = Path(__file__).parent.parent / "knowledgebase.json"
     npcs_path = Path(__file__).parent.parent / "npcs.json"
 
@@ -137,11 +230,12 @@ async def startup_event():
     else:
         logger.warning("Hiçbir NPC dosyası bulunamadı!")
 
-    # ── Pipeline Warmup (sunucu warmup bitene kadar istek almaz) ──
-    await _warmup_pipeline()
 
-    # ── Keep-alive ping iptal edildi (istek üzerine) ──
-    # asyncio.create_task(_keep_alive_loop())
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Kalıcı HTTP bağlantılarını ve TTS thread havuzunu düzgünce kapatır."""
+    await asyncio.gather(close_stt_client(), close_llm_clients())
+    shutdown_tts_executor()
 
 
 async def _warmup_pipeline():
@@ -150,23 +244,29 @@ async def _warmup_pipeline():
     logger.info("🔥 Pipeline warmup başlatılıyor...")
     t0 = time.perf_counter()
 
-    warmup_wav = _load_warmup_wav()
-    if warmup_wav is None:
-        logger.warning("  ⚠️ warmup.wav bulunamadı — STT warmup atlanıyor")
+    # Disk okuması thread'de; LLM/TTS warmup istekleri bu sırada yola çıkar
+    wav_task = asyncio.create_task(_load_warmup_wav())
 
     async def warmup_stt():
+        warmup_wav = await wav_task
         if warmup_wav is None:
+            logger.warning("  ⚠️ warmup.wav bulunamadı — STT warmup atlanıyor")
             return
-        # Çift warmup: 1) instance uyandır + model yükle  2) inference cache ısıt
-        try:
-            r1 = await transcribe_audio(warmup_wav, language="tr")
-            logger.info(f"  ✅ STT warm #1 ({r1['stt_time_ms']:.0f}ms)")
-            r2 = await transcribe_audio(warmup_wav, language="tr")
-            logger.info(f"  ✅ STT warm #2 ({r2['stt_time_ms']:.0f}ms)")
-        except Exception as e:
-            logger.warning(f"  ⚠️ STT warmup başarısız (sorun değil): {e}")
+        # Paralel warmup: eşzamanlı istekler serverless STT'de ayrı instance'lara
+        # düşer, böylece birden fazla replica aynı sürede ısınır
+        results = await asyncio.gather(
+            *(transcribe_audio(warmup_wav, language="tr") for _ in range(STT_WARMUP_CALLS)),
+            return_exceptions=True,
+        )
+        for i, result in enumerate(results, 1):
+            if isinstance(result, BaseException):
+                logger.warning(f"  ⚠️ STT warm #{i} başarısız (sorun değil): {result}")
+            else:
+                logger.info(f"  ✅ STT warm #{i} ({result['stt_time_ms']:.0f}ms)")
 
     async def warmup_llm():
+        # Aktif sağlayıcının HTTP/2 bağlantısı + TLS oturumu burada kurulur,
+        # ilk oyuncu isteği handshake beklemez
         try:
             from app.llm_service import _call_llm, LLM_MODEL, LLM_TEMPERATURE
             await _call_llm({
@@ -195,15 +295,51 @@ async def _warmup_pipeline():
     logger.info(f"🔥 Pipeline warmup tamamlandı: {elapsed:.0f}ms")
 
 
-def _load_warmup_wav() -> bytes | None:
-    """backend/warmup.wav dosyasını diskten okur.
+async def _load_warmup_wav() -> bytes | None:
+    """backend/warmup.wav dosyasını diskten okur (thread'de).
     Dosya yoksa None döner."""
     warmup_path = Path(__file__).parent.parent / "warmup.wav"
-    if warmup_path.exists():
-        data = warmup_path.read_bytes()
+
+    def _read() -> bytes | None:
+        try:
+            return warmup_path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    data = await asyncio.to_thread(_read)
+    if data is not None:
         logger.info(f"  📁 warmup.wav yüklendi: {len(data)} bytes ({warmup_path})")
-        return data
-    return None
+    return data
+
+
+# ─── Hafıza Özeti (Compaction) ─────────────────────────────────
+
+def _schedule_compaction(npc_id: str) -> None:
+    """NPC'nin recent katmanından düşen mesajlar varsa özet güncellemesini
+    arka planda başlatır. Yanıt akışını bekletmez."""
+    _spawn_background(_compact_summary(npc_id))
+
+
+async def _compact_summary(npc_id: str) -> None:
+    """Bekleyen mesajları LLM ile mevcut özete katar (kuyruk boşalana kadar)."""
+    while True:
+        job = store.begin_compaction(npc_id)
+        if job is None:
+            return
+        summary, pending, generation = job
+        try:
+            new_summary = await summarize_history(summary, pending)
+        except Exception as e:
+            logger.warning(f"Özet güncellenemedi (NPC={npc_id}): {e}")
+            store.finish_compaction(npc_id, generation, None, pending)
+            return
+        if not new_summary:
+            # Boş/filtrelenmiş çıktı: eski özet korunur, mesajlar kuyruğa geri döner
+            logger.warning(f"Özet boş döndü (NPC={npc_id}) — bekleyen mesajlar kuyrukta kalıyor")
+            store.finish_compaction(npc_id, generation, None, pending)
+            return
+        if not store.finish_compaction(npc_id, generation, new_summary, pending):
+            return
 
 
 # ─── Ana Pipeline (Non-Streaming) ──────────────────────────────
@@ -223,6 +359,17 @@ async def start_convo(request: StartConvoRequest):
 
     logger.info(f"Diyalog başlatılıyor: NPC={npc_id}")
 
+    cache_key = _start_cache_key(npc_id, instruction)
+    cached = _start_cache_get(cache_key)
+    if cached is not None:
+        # Aynı NPC + talimat + knowledge base sürümü — LLM ve TTS atlanır
+        llm_result, audio_content = cached
+        npc_text = llm_result["text"]
+        store.add_assistant_message(npc_id, npc_text)
+        _schedule_compaction(npc_id)
+        logger.info(f"Diyalog başlatma önbellekten: NPC={npc_id}")
+        return _start_convo_response(llm_result, audio_content, pipeline_ms=0.0)
+
     try:
         main_story = registry.get_main_story()
         llm_result = await generate_starter_response(
@@ -230,35 +377,71 @@ async def start_convo(request: StartConvoRequest):
         )
         npc_text = llm_result["text"]
         store.add_assistant_message(npc_id, npc_text)
+        _schedule_compaction(npc_id)
 
         voice = npc_config.get("voice", "alloy")
         tts_result = await text_to_speech_wav(npc_text, voice=voice)
         audio_content = tts_result["audio_bytes"]
         tts_time_ms = tts_result["tts_time_ms"]
         pipeline_ms = round(llm_result["llm_time_ms"] + tts_time_ms, 1)
+        _start_cache_put(cache_key, llm_result, audio_content)
 
         _log_pipeline("start_convo", llm_ms=llm_result["llm_time_ms"],
                       tts_total_ms=tts_time_ms, total_ms=pipeline_ms, npc_text=npc_text,
                       action=llm_result.get("action", ""), price=llm_result.get("price", 0),
                       mood=llm_result.get("mood", ""), note=llm_result.get("note", ""))
 
-        return Response(
-            content=audio_content, media_type="audio/wav",
-            headers={
-                "X-NPC-Response-Text": quote(npc_text),
-                "X-NPC-Action": llm_result.get("action", ""),
-                "X-NPC-Price": str(llm_result.get("price", 0)),
-                "X-NPC-Mood": llm_result.get("mood", ""),
-                "X-NPC-Note": quote(llm_result.get("note", ""), safe=""),
-                "X-Pipeline-Time-Ms": str(pipeline_ms),
-                "Access-Control-Expose-Headers": "*",
-            },
-        )
+        return _start_convo_response(llm_result, audio_content, pipeline_ms)
     except Exception as e:
         logger.error(f"Diyalog başlatma hatası: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _start_convo_response(llm_result: dict, audio_content: bytes, pipeline_ms: float) -> Response:
+    return Response(
+        content=audio_content, media_type="audio/wav",
+        headers={
+            "X-NPC-Response-Text": _quote_header(llm_result["text"], safe="/"),
+            "X-NPC-Action": llm_result.get("action", ""),
+            "X-NPC-Price": str(llm_result.get("price", 0)),
+            "X-NPC-Mood": llm_result.get("mood", ""),
+            "X-NPC-Note": _qnote(llm_result.get("note", "")),
+            "X-Pipeline-Time-Ms": str(pipeline_ms),
+        },
+    )
+
+
+# ─── /start_convo Yanıt Önbelleği ──────────────────────────────
+
+# cache_key -> (llm_result, wav_bytes); en son kullanılan sonda (LRU)
+_start_cache: OrderedDict[bytes, tuple[dict, bytes]] = OrderedDict()
+_START_CACHE_ENABLED = START_CONVO_CACHE_SIZE > 0 and LLM_TEMPERATURE == 0
+
+
+def _start_cache_key(npc_id: str, instruction: str) -> bytes:
+    """Registry sürümü anahtara girer — knowledge base değişince eski kayıtlar eşleşmez."""
+    raw = f"{registry.version}\x00{npc_id}\x00{instruction}".encode()
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def _start_cache_get(key: bytes) -> tuple[dict, bytes] | None:
+    if not _START_CACHE_ENABLED:
+        return None
+    entry = _start_cache.get(key)
+    if entry is not None:
+        _start_cache.move_to_end(key)
+    return entry
+
+
+def _start_cache_put(key: bytes, llm_result: dict, wav_bytes: bytes) -> None:
+    if not _START_CACHE_ENABLED:
+        return
+    _start_cache[key] = (llm_result, wav_bytes)
+    _start_cache.move_to_end(key)
+    while len(_start_cache) > START_CONVO_CACHE_SIZE:
+        _start_cache.popitem(last=False)
+
+
 
 # ─── Hallüsinasyon Filtresi ────────────────────────────────────
 # STT modelleri bazen boş seste bu tarz çıktılar uydurur.
@@ -268,50 +451,114 @@ IGNORE_PHRASES = {
     "Görüşürüz.", "Hoşça kalın.", "...", ".", "", "altyazı"
 }
 
+def _lower_tr(text: str) -> str:
+    """Küçük harfe çevirir; 'İ'.lower() birleşik nokta ürettiği için önce düz 'i' yapılır."""
+    return text.replace("İ", "i").lower()
+
+
+# Karşılaştırma küçük harfle yapılır — STT'nin büyük/küçük harf farkı eşleşmeyi bozmasın
+_IGNORE_PHRASES_LOWER = frozenset(_lower_tr(p) for p in IGNORE_PHRASES)
+# Kendi kendine konuşan altyazı pattern'ları (tek regex taraması)
+_HALLUC_RE = re.compile(r"altyazı|subtitle", re.IGNORECASE)
+
+
 def _is_hallucination(text: str) -> bool:
     if not text:
         return True
     t = text.strip()
-    if t in IGNORE_PHRASES:
-        return True
     # Çok kısa ve anlamsız
     if len(t) < 2:
         return True
-    # Kendi kendine konuşan altyazı pattern'ları
-    t_lower = t.lower()
-    if "altyazı" in t_lower or "subtitle" in t_lower:
+    t_lower = _lower_tr(t)
+    if t_lower in _IGNORE_PHRASES_LOWER:
         return True
-    return False
+    return _HALLUC_RE.search(t_lower) is not None
+
 
 async def _wait_for_missing_chunks(session_id: str, timeout: float = 2.0):
     """
     Session içinde aradaki eksik chunk'ları (örneğin 0, 2 geldi ama 1 yok) bekler.
     Son chunk'ın gelip gelmediğini bilemeyiz, sadece ARADAKİ boşlukları doldurmaya çalışırız.
+    Polling yapılmaz: yeni chunk eklendiğinde store'daki session event'i ile uyanılır.
     """
-    start_time = time.perf_counter()
-    while (time.perf_counter() - start_time) < timeout:
+    deadline = time.perf_counter() + timeout
+    event = None
+    while True:
+        # Indexler sıralı gelir — boşluk yoksa aralık uzunluğu eleman sayısına eşittir
         indices = store.get_session_indices(session_id)
-        if not indices:
-            break
-            
-        min_idx = min(indices)
-        max_idx = max(indices)
-        
-        # Beklenen: [min_idx, min_idx+1, ... max_idx]
-        current_set = set(indices)
-        expected_set = set(range(min_idx, max_idx + 1))
-        missing = expected_set - current_set
-        
-        if not missing:
+        if not indices or indices[-1] - indices[0] + 1 == len(indices):
             return  # Eksik yok, devam et
-            
-        # Eksik var, biraz bekle
-        await asyncio.sleep(0.1)
-    
+
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        # Kontrol ile clear arasında await yok — arada gelen sinyal kaçmaz
+        if event is None:
+            event = store.get_chunk_event(session_id)
+        event.clear()
+        try:
+            await asyncio.wait_for(event.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+
     # Timeout oldu, ne varsa onunla devam et
     logger.warning(f"Session {session_id} için eksik chunk bekleme süresi doldu.")
 
 
+# Yüklenen ses STT'ye bu boyutta parçalar halinde akıtılır
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+async def _iter_upload(audio: UploadFile):
+    """UploadFile içeriğini tek bir bytes'a toplamadan parça parça okur."""
+    while chunk := await audio.read(_UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+def _transcribe_upload(audio: UploadFile):
+    """UploadFile'ı belleğe okumadan STT'ye akıtan coroutine'i döner."""
+    return transcribe_audio(_iter_upload(audio), language="tr", size=audio.size)
+
+
+def _start_final_stt(audio: UploadFile | None, log_prefix: str | None = None,
+                     session_id: str | None = None) -> asyncio.Task | None:
+    """Son ses parçasının STT'sini arka planda başlatır.
+    Böylece eksik chunk beklemesi ile STT üst üste biner (wait + stt yerine max).
+    Ses yoksa veya boşsa None döner."""
+    if not audio:
+        return None
+    if log_prefix:
+        logger.info(f"{log_prefix}: {audio.size} bytes, session={session_id}")
+    if audio.size == 0:
+        return None
+    return asyncio.create_task(_transcribe_upload(audio))
+
+
+def _discard_task(task: asyncio.Task | None) -> None:
+    """Sonucu artık beklenmeyecek task'ı bırakır: sürüyorsa iptal eder,
+    bitmişse hatasını tüketir ("Task exception was never retrieved" olmasın)."""
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+def _load_turn_context(npc_id: str, user_text: str) -> dict:
+    """Kullanıcı mesajını store'a ekler ve LLM'e gidecek bağlamı tek seferde toplar.
+    Hepsi kısa, lock'lu bellek okumaları (cross-NPC özeti memoize) olduğu için
+    doğrudan event loop'ta çalışır — thread'e atmak sadece geçiş maliyeti ekler.
+    Returns: generate_response / generate_response_stream keyword argümanları"""
+    store.add_user_message(npc_id, user_text)
+    return {
+        "conversation_history": store.get_history_for_prompt(npc_id),
+        "user_message": user_text,
+        "main_story": registry.get_main_story(),
+        "cross_npc_context": store.get_summary_for_context(exclude_npc_id=npc_id),
+    }
+
+
 @app.post("/upload_audio_chunk")
 async def upload_audio_chunk(
     audio: UploadFile = File(..., description="WAV formatında ses dosyası"),
@@ -322,13 +569,12 @@ async def upload_audio_chunk(
     Sessizlik anında gönderilen ses parçasını alır, STT yapar ve hafızada tutar.
     Push-to-talk bitince /talk veya /talk_stream çağrılır.
     """
-    audio_bytes = await audio.read()
-    if len(audio_bytes) == 0:
+    if audio.size == 0:
         return {"status": "empty", "text": ""}
 
     try:
-        # Hızlıca STT yap
-        stt_result = await transcribe_audio(audio_bytes, language="tr")
+        # Hızlıca STT yap (ses belleğe toplanmadan upstream'e akıtılır)
+        stt_result = await _transcribe_upload(audio)
         text = stt_result["text"].strip()
         
         if _is_hallucination(text):
@@ -371,36 +617,42 @@ async def talk(
     final_user_text = ""
     stt_time_ms = 0.0
 
+    # Son parçanın STT'si eksik chunk beklemesiyle paralel başlar
+    final_stt_task = _start_final_stt(audio)
+
     # A) Stored Chunks
-    if session_id:
-        # Eksik chunk'ları bekle
-        await _wait_for_missing_chunks(session_id)
-        stored_text, last_chunk_stt_ms = store.finalize_session(session_id)
-        if stored_text:
-            final_user_text += stored_text + " "
-            # Eğer şu anki audio yoksa, son chunk stt süresi stored olandır
-            if not audio:
-                # Burada stt_time_ms'i son chunk süresi olarak set etmek tartışmalı ama istenen bu
-                # stt_time_ms = last_chunk_stt_ms 
-                pass
+    try:
+        if session_id:
+            # Eksik chunk'ları bekle
+            await _wait_for_missing_chunks(session_id)
+            stored_text, last_chunk_stt_ms = store.finalize_session(session_id)
+            if stored_text:
+                final_user_text += stored_text + " "
+                # Eğer şu anki audio yoksa, son chunk stt süresi stored olandır
+                if not audio:
+                    # Burada stt_time_ms'i son chunk süresi olarak set etmek tartışmalı ama istenen bu
+                    # stt_time_ms = last_chunk_stt_ms 
+                    pass
+    except BaseException:
+        # Hata/iptal: STT task'ı handler kapanınca kapanan UploadFile'dan okumaya devam etmesin
+        _discard_task(final_stt_task)
+        raise
 
     # B) Current Audio (Final Chunk)
-    if audio:
-        audio_bytes = await audio.read()
-        if len(audio_bytes) > 0:
-            try:
-                stt_result = await transcribe_audio(audio_bytes, language="tr")
-                current_text = stt_result["text"].strip()
-                if current_text:
-                    final_user_text += current_text
-                # stt_time_ms burada sadece son parçanın süresi olurdu,
-                # ama biz toplam 'metin hazırlama' süresini ölçmek istiyoruz.
-            except Exception as e:
-                # Eğer stored text varsa ve bu patladıysa, stored ile devam etmeye çalışalım mı?
-                # Şimdilik hata dönüyoruz ama loglayıp devam edilebilir.
-                logger.error(f"Final audio STT hatası: {e}")
-                if not final_user_text:
-                    raise HTTPException(status_code=502, detail=f"STT hatası: {e}")
+    if final_stt_task is not None:
+        try:
+            stt_result = await final_stt_task
+            current_text = stt_result["text"].strip()
+            if current_text:
+                final_user_text += current_text
+            # stt_time_ms burada sadece son parçanın süresi olurdu,
+            # ama biz toplam 'metin hazırlama' süresini ölçmek istiyoruz.
+        except Exception as e:
+            # Eğer stored text varsa ve bu patladıysa, stored ile devam etmeye çalışalım mı?
+            # Şimdilik hata dönüyoruz ama loglayıp devam edilebilir.
+            logger.error(f"Final audio STT hatası: {e}")
+            if not final_user_text:
+                raise HTTPException(status_code=502, detail=f"STT hatası: {e}")
 
     final_user_text = final_user_text.strip()
     if not final_user_text:
@@ -414,25 +666,17 @@ async def talk(
     stt_time_ms = (stt_end_time - pipeline_start) * 1000
     
     # ... Pipeline devamı (Store, LLM, TTS) ...
-    store.add_user_message(npc_id, user_text)
-    history_for_llm = store.get_messages(npc_id)[:-1]
-    cross_context = store.get_summary_for_context(exclude_npc_id=npc_id)
+    turn_context = _load_turn_context(npc_id, user_text)
 
     try:
-        main_story = registry.get_main_story()
-        llm_result = await generate_response(
-            npc_config=npc_config,
-            conversation_history=history_for_llm,
-            user_message=user_text,
-            main_story=main_story,
-            cross_npc_context=cross_context,
-        )
+        llm_result = await generate_response(npc_config=npc_config, **turn_context)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"LLM hatası: {e}")
 
     npc_response_text = llm_result["text"]
     llm_time_ms = llm_result["llm_time_ms"]
     store.add_assistant_message(npc_id, npc_response_text)
+    _schedule_compaction(npc_id)
 
     npc_voice = npc_config.get("voice", "alloy")
     try:
@@ -454,23 +698,76 @@ async def talk(
         content=wav_bytes, media_type="audio/wav",
         headers={
             "X-NPC-Id": npc_id,
-            "X-NPC-Response-Text": quote(npc_response_text, safe=""),
+            "X-NPC-Response-Text": _quote_header(npc_response_text),
             "X-NPC-Action": llm_result.get("action", ""),
             "X-NPC-Price": str(llm_result.get("price", 0)),
             "X-NPC-Mood": llm_result.get("mood", ""),
-            "X-NPC-Note": quote(llm_result.get("note", ""), safe=""),
-            "X-User-Text": quote(user_text, safe=""),
+            "X-NPC-Note": _qnote(llm_result.get("note", "")),
+            "X-User-Text": _quote_header(user_text),
             "X-Pipeline-Time-Ms": str(round(pipeline_ms, 1)),
             "X-STT-Time-Ms": str(round(stt_time_ms, 1)),
             "X-LLM-Time-Ms": str(round(llm_time_ms, 1)),
             "X-TTS-Time-Ms": str(round(tts_time_ms, 1)),
-            "Access-Control-Expose-Headers": "*",
         },
     )
 
 
 # ─── Streaming Endpoint'ler (LLM Streaming + TTS Overlap) ──────
 
+# SSE frame'leri doğrudan bytes olarak üretilir (orjson UTF-8 bytes döner,
+# StreamingResponse tekrar encode etmez)
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+# Tüm streaming endpoint'lerde aynı — CORS header'larını CORSMiddleware ekler
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+
+# Metadata event'inin her istekte aynı olan alanları
+_META_CONST = {
+    "npc_text": "",  # Tam metin done event'inde gelecek
+    "action": "",
+    "price": 0,
+    "mood": "",
+    "note": "",
+    "sample_rate": SAMPLE_RATE,
+    "channels": 1,
+    "bits_per_sample": 16,
+}
+
+
+def _sse_event(payload: dict) -> bytes:
+    """Bir dict'i tek SSE 'data:' frame'ine çevirir."""
+    return _SSE_PREFIX + orjson.dumps(payload) + _SSE_SUFFIX
+
+
+# Turun ilk cümlesi TTS'e kısa bir parça olarak gider (ilk ses daha erken
+# gelir); kalan kısım ve sonraki cümleler cümle bütünlüğünü korur
+FIRST_CHUNK_MAX_WORDS = 5
+_FIRST_CHUNK_COMMA_MIN_WORDS = 4
+_FIRST_CHUNK_MIN_TAIL_WORDS = 3  # Daha kısa kalan ayrı bir TTS isteğine değmez
+_WORD_RE = re.compile(r"\S+")
+
+
+def _split_first_chunk(text: str, max_words: int = FIRST_CHUNK_MAX_WORDS) -> tuple[str, str]:
+    """İlk cümleyi (baş, kalan) olarak böler.
+    Kesim noktası: en az 4 kelimeden sonra gelen ilk virgül ya da max_words
+    kelime — hangisi önce gelirse. Kalan çok kısaysa ya da cümle zaten
+    kısaysa bölünmez, kalan boş döner."""
+    for i, match in enumerate(_WORD_RE.finditer(text), 1):
+        if i >= max_words or (i >= _FIRST_CHUNK_COMMA_MIN_WORDS and match.group().endswith(",")):
+            end = match.end()
+            tail = text[end:].strip()
+            if len(tail.split()) < _FIRST_CHUNK_MIN_TAIL_WORDS:
+                break
+            return text[:end], tail
+    return text, ""
+
+
 def _create_streaming_sse_generator(
     pipeline_start: float,
     llm_stream_gen,
@@ -486,103 +783,117 @@ def _create_streaming_sse_generator(
     """
     async def sse_generator():
         # ── Hemen metadata gönder (npc_text henüz bilinmiyor) ──
-        metadata = {
-            "type": "metadata",
-            "npc_id": npc_id,
-            "npc_text": "",  # Tam metin done event'inde gelecek
-            "action": "",
-            "price": 0,
-            "mood": "",
-            "note": "",
-            "sample_rate": SAMPLE_RATE,
-            "channels": 1,
-            "bits_per_sample": 16,
-        }
+        metadata = {"type": "metadata", "npc_id": npc_id, **_META_CONST}
         if stt_time_ms is not None:
             metadata["stt_time_ms"] = round(stt_time_ms, 1)
             metadata["user_text"] = user_text
         if final_chunk_stt_ms is not None:
             metadata["final_chunk_stt_ms"] = round(final_chunk_stt_ms, 1)
-        yield f"data: {json.dumps(metadata, ensure_ascii=False)}\n\n"
-
-        # ── Queue'lar ──
-        sentence_q = thread_queue.Queue()       # LLM → TTS (thread-safe)
-        audio_q: asyncio.Queue = asyncio.Queue() # TTS → SSE (async)
+        yield _sse_event(metadata)
+        # Metadata frame'i socket'e yazılsın diye kontrolü bir tur loop'a bırak —
+        # client ses çalıcıyı LLM çalışırken hazırlar. LLM akışı da tembeldir:
+        # prompt kurulumu ve provider bağlantısı ilk __anext__'te (llm_producer) başlar
+        await asyncio.sleep(0)
+
+        # ── Queue'lar (ikisi de event loop içinde — thread köprüsü yok) ──
+        sentence_q: asyncio.Queue[str | None] = asyncio.Queue()  # LLM → TTS
+        audio_q: asyncio.Queue = asyncio.Queue()                  # TTS → SSE
         llm_done_info = {}
 
         # ── LLM Producer (async) — cümleleri sentence_q'ya atar ──
         async def llm_producer():
+            is_first_sentence = True
             try:
                 async for item in llm_stream_gen:
                     if item["type"] == "sentence":
-                        sentence_q.put(item["text"])
+                        if is_first_sentence:
+                            is_first_sentence = False
+                            head, tail = _split_first_chunk(item["text"])
+                            sentence_q.put_nowait(head)
+                            if tail:
+                                sentence_q.put_nowait(tail)
+                        else:
+                            sentence_q.put_nowait(item["text"])
                     elif item["type"] == "done":
                         llm_done_info.update(item)
-                        sentence_q.put(None)  # Bitti sinyali
+                        sentence_q.put_nowait(None)  # Bitti sinyali
             except Exception as e:
                 logger.error(f"LLM producer hatası: {e}")
                 llm_done_info["error"] = str(e)
-                sentence_q.put(None)
+                sentence_q.put_nowait(None)
 
-        # ── TTS Worker (thread) — cümleleri alır, TTS yapar, audio_q'ya atar ──
-        tts_timings = {"first_sentence_received": None}  # thread-safe dict
+        # ── TTS Consumer (async) — cümleleri alır, TTS yapar, audio_q'ya atar ──
+        tts_timings = {"first_sentence_received": None}
 
-        def tts_worker():
+        async def tts_consumer():
             is_first = True
-            while True:
-                sentence = sentence_q.get()  # Blocking — LLM cümle üretene kadar bekle
-                if sentence is None:
-                    audio_q.put_nowait(None)
-                    break
-                if is_first:
-                    tts_timings["first_sentence_received"] = time.perf_counter()
-                    is_first = False
-                try:
-                    for chunk in text_to_speech_stream(sentence, voice=npc_voice):
-                        if chunk["type"] == "audio":
-                            audio_q.put_nowait(chunk)
-                        # Bireysel TTS "done" event'lerini atla
-                except Exception as e:
-                    logger.error(f"TTS worker hatası (cümle: '{sentence[:30]}...'): {e}")
+            try:
+                while True:
+                    sentence = await sentence_q.get()  # LLM cümle üretene kadar bekle
+                    if sentence is None:
+                        break
+                    first_chunk = is_first
+                    if is_first:
+                        tts_timings["first_sentence_received"] = time.perf_counter()
+                        is_first = False
+                    try:
+                        # İlk cümle hızlı ilk-chunk ayarıyla, kalanlar varsayılanla
+                        async for chunk in text_to_speech_stream_async(
+                            sentence, voice=npc_voice, first_chunk=first_chunk
+                        ):
+                            if chunk["type"] == "audio":
+                                audio_q.put_nowait(chunk)
+                            # Bireysel TTS "done" event'lerini atla
+                    except Exception as e:
+                        logger.error(f"TTS consumer hatası (cümle: '{sentence[:30]}...'): {e}")
+            finally:
+                audio_q.put_nowait(None)  # SSE döngüsü her durumda sonlansın
 
         # ── Her ikisini başlat ──
         llm_task = asyncio.create_task(llm_producer())
-        loop = asyncio.get_event_loop()
-        tts_future = loop.run_in_executor(None, tts_worker)
-
-        # ── Audio chunk'ları SSE olarak yield et ──
-        global_chunk_index = 0
-        first_audio_pipeline_ms = None
-        tts_first_chunk_ms = None  # TTS'in kendi ilk chunk süresi (TTS başlangıcından)
-        tts_start_time = None
-
-        while True:
-            chunk = await audio_q.get()
-            if chunk is None:
-                break
+        tts_task = asyncio.create_task(tts_consumer())
+
+        # Client koparsa (generator kapanır) görevler ve LLM akışı arkada
+        # çalışmaya devam etmesin — her çıkışta iptal edilip beklenir
+        try:
+            # ── Audio chunk'ları SSE olarak yield et ──
+            global_chunk_index = 0
+            first_audio_pipeline_ms = None
+            tts_first_chunk_ms = None  # TTS'in kendi ilk chunk süresi (TTS başlangıcından)
+            tts_start_time = None
+
+            while True:
+                chunk = await audio_q.get()
+                if chunk is None:
+                    break
 
-            global_chunk_index += 1
-            chunk["chunk_index"] = global_chunk_index
-
-            # İlk audio chunk — pipeline first audio latency
-            if global_chunk_index == 1:
-                now = time.perf_counter()
-                first_audio_pipeline_ms = round(
-                    (now - pipeline_start) * 1000, 1
-                )
-                # TTS ilk chunk süresi = ilk audio chunk - TTS'in ilk cümleyi aldığı an
-                t_recv = tts_timings.get("first_sentence_received")
-                if t_recv:
-                    tts_first_chunk_ms = round((now - t_recv) * 1000, 1)
-                tts_start_time = now
-                chunk["pipeline_first_audio_ms"] = first_audio_pipeline_ms
-                chunk["first_chunk_ms"] = first_audio_pipeline_ms
-
-            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-
-        # ── Bitmesini bekle ──
-        await llm_task
-        await tts_future
+                global_chunk_index += 1
+                chunk["chunk_index"] = global_chunk_index
+
+                # İlk audio chunk — pipeline first audio latency
+                if global_chunk_index == 1:
+                    now = time.perf_counter()
+                    first_audio_pipeline_ms = round(
+                        (now - pipeline_start) * 1000, 1
+                    )
+                    # TTS ilk chunk süresi = ilk audio chunk - TTS'in ilk cümleyi aldığı an
+                    t_recv = tts_timings.get("first_sentence_received")
+                    if t_recv:
+                        tts_first_chunk_ms = round((now - t_recv) * 1000, 1)
+                    tts_start_time = now
+                    chunk["pipeline_first_audio_ms"] = first_audio_pipeline_ms
+                    chunk["first_chunk_ms"] = first_audio_pipeline_ms
+
+                yield _sse_event(chunk)
+
+            # ── Bitmesini bekle ──
+            await asyncio.gather(llm_task, tts_task)
+        finally:
+            for task in (llm_task, tts_task):
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(llm_task, tts_task, return_exceptions=True)
+            await llm_stream_gen.aclose()
 
         # ── Store'a kaydet ──
         npc_text = llm_done_info.get("full_text", "")
@@ -591,6 +902,7 @@ def _create_streaming_sse_generator(
 
         if npc_text:
             store.add_assistant_message(npc_id, npc_text)
+            _schedule_compaction(npc_id)
 
         # ── Done event ──
         pipeline_total_ms = round((time.perf_counter() - pipeline_start) * 1000, 1)
@@ -613,10 +925,10 @@ def _create_streaming_sse_generator(
             "pipeline_total_ms": pipeline_total_ms,
             "pipeline_first_audio_ms": first_audio_pipeline_ms,
         }
-        yield f"data: {json.dumps(done_event, ensure_ascii=False)}\n\n"
+        yield _sse_event(done_event)
 
-        # ── Log ──
-        _log_pipeline(
+        # ── Log (arka planda — stream hemen kapanır) ──
+        _log_pipeline_background(
             "streaming_pipeline",
             stt_ms=stt_time_ms,
             final_chunk_stt_ms=final_chunk_stt_ms,
@@ -658,34 +970,39 @@ async def talk_stream(
     stt_time_ms = 0.0
     final_chunk_stt_ms = None
 
+    # Son parçanın STT'si eksik chunk beklemesiyle paralel başlar
+    final_stt_task = _start_final_stt(audio, log_prefix="🎤 STREAM Talk Final Audio",
+                                      session_id=session_id)
+
     # A) Stored Chunks
-    if session_id:
-        # Eksik chunk'ları bekle
-        await _wait_for_missing_chunks(session_id)
-        stored_text, last_chunk_stt = store.finalize_session(session_id)
-        if stored_text:
-            final_user_text += stored_text + " "
-            # Eğer audio yoksa, final_chunk_stt_ms olarak son store edilen chunk süresini kullan
-            if not audio and last_chunk_stt is not None:
-                final_chunk_stt_ms = last_chunk_stt
+    try:
+        if session_id:
+            # Eksik chunk'ları bekle
+            await _wait_for_missing_chunks(session_id)
+            stored_text, last_chunk_stt = store.finalize_session(session_id)
+            if stored_text:
+                final_user_text += stored_text + " "
+                # Eğer audio yoksa, final_chunk_stt_ms olarak son store edilen chunk süresini kullan
+                if not audio and last_chunk_stt is not None:
+                    final_chunk_stt_ms = last_chunk_stt
+    except BaseException:
+        _discard_task(final_stt_task)
+        raise
 
     # B) Current Audio
-    if audio:
-        audio_bytes = await audio.read()
-        logger.info(f"🎤 STREAM Talk Final Audio: {len(audio_bytes)} bytes, session={session_id}")
-        if len(audio_bytes) > 0:
-            try:
-                stt_result = await transcribe_audio(audio_bytes, language="tr")
-                current_text = stt_result["text"].strip()
-                if current_text:
-                    final_user_text += current_text
-                
-                # Son parçanın STT süresini sakla
-                final_chunk_stt_ms = stt_result.get("stt_time_ms")
-            except Exception as e:
-                logger.error(f"Final audio STT hatası: {e}")
-                if not final_user_text:
-                    raise HTTPException(status_code=502, detail=f"STT hatası: {e}")
+    if final_stt_task is not None:
+        try:
+            stt_result = await final_stt_task
+            current_text = stt_result["text"].strip()
+            if current_text:
+                final_user_text += current_text
+            
+            # Son parçanın STT süresini sakla
+            final_chunk_stt_ms = stt_result.get("stt_time_ms")
+        except Exception as e:
+            logger.error(f"Final audio STT hatası: {e}")
+            if not final_user_text:
+                raise HTTPException(status_code=502, detail=f"STT hatası: {e}")
 
     final_user_text = final_user_text.strip()
     if not final_user_text:
@@ -698,18 +1015,8 @@ async def talk_stream(
     stt_time_ms = (stt_end_time - pipeline_start) * 1000
     
     # ... Pipeline devamı ...
-    store.add_user_message(npc_id, user_text)
-    history_for_llm = store.get_messages(npc_id)[:-1]
-    cross_context = store.get_summary_for_context(exclude_npc_id=npc_id)
-
-    main_story = registry.get_main_story()
-    llm_stream = generate_response_stream(
-        npc_config=npc_config,
-        conversation_history=history_for_llm,
-        user_message=user_text,
-        main_story=main_story,
-        cross_npc_context=cross_context,
-    )
+    turn_context = _load_turn_context(npc_id, user_text)
+    llm_stream = generate_response_stream(npc_config=npc_config, **turn_context)
 
     npc_voice = npc_config.get("voice", "alloy")
 
@@ -724,13 +1031,7 @@ async def talk_stream(
             user_text=user_text,
         ),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Expose-Headers": "*",
-        },
+        headers=_SSE_HEADERS,
     )
 
 
@@ -767,13 +1068,7 @@ async def start_convo_stream(request: StartConvoRequest):
             npc_voice=voice,
         ),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Expose-Headers": "*",
-        },
+        headers=_SSE_HEADERS,
     )
 
 
@@ -786,7 +1081,9 @@ async def enter_knowledgebase(request: KnowledgeBaseRequest):
     Mevcut registry'yi siler, yeni veriyi 'knowledgebase.json' olarak kaydeder.
     """
     kb_path = Path(__file__).parent.parent / "knowledgebase.json"
-    count = registry.overwrite_and_save(request.model_dump(), kb_path)
+    count = await asyncio.to_thread(registry.overwrite_and_save, request.model_dump(), kb_path)
+    # Eski knowledge base'e ait hazır açılış yanıtlarını bellekten at
+    _start_cache.clear()
     
     logger.info(f"Knowledge Base güncellendi ve kaydedildi: {kb_path} ({count} NPC)")
     return {
@@ -796,10 +1093,22 @@ async def enter_knowledgebase(request: KnowledgeBaseRequest):
     }
 
 
+# /npcs yanıtı registry sürümüyle, serialize edilmiş JSON olarak önbelleklenir:
+# (sürüm, body). FastAPI'nin jsonable_encoder + json.dumps yolu hiç çalışmaz
+_npcs_payload: tuple[int, bytes] | None = None
+
+
 @app.get("/npcs")
 async def list_npcs():
-    """Tüm kayıtlı NPC'leri listeler."""
-    return {"npcs": registry.list_npcs()}
+    """Tüm kayıtlı NPC'leri listeler. Registry değişmedikçe aynı JSON body döner."""
+    global _npcs_payload
+    # Sürüm listeden önce okunur — yazıcı arada gelirse sonraki istek yeniden kurar
+    version = registry.version
+    if _npcs_payload is None or _npcs_payload[0] != version:
+        # NPC'ler salt-okunur MappingProxyType — orjson default=dict ile açar
+        body = orjson.dumps({"npcs": registry.list_npcs()}, default=dict)
+        _npcs_payload = (version, body)
+    return Response(content=_npcs_payload[1], media_type="application/json")
 
 
 @app.get("/npcs/{npc_id}")
@@ -815,16 +1124,19 @@ async def get_npc(npc_id: str):
 
 @app.get("/conversations")
 async def get_all_conversations():
-    """Tüm NPC konuşmalarını döner (debug/admin)."""
+    """Tüm NPC konuşmalarının özetini ve son mesajlarını döner (debug/admin).
+    Tam geçmiş için /conversations/{npc_id} kullanılır."""
     return store.get_all_conversations()
 
 
 @app.get("/conversations/{npc_id}")
-async def get_conversation(npc_id: str):
-    """Bir NPC'nin konuşma geçmişini döner."""
-    conv = store.get_conversation(npc_id)
+async def get_conversation(npc_id: str, offset: int | None = None,
+                           limit: int = CONVERSATION_PAGE_LIMIT):
+    """Bir NPC'nin konuşma geçmişini sayfa sayfa döner (varsayılan: en yeni mesajlar).
+    Daha eskiler için offset ile geriye gidilir."""
+    conv = store.get_conversation(npc_id, offset=offset, limit=limit)
     if conv is None:
-        return {"npc_id": npc_id, "messages": []}
+        return {"npc_id": npc_id, "message_count": 0, "offset": 0, "messages": []}
     return conv
 
 
@@ -847,12 +1159,11 @@ async def clear_all_conversations():
 @app.get("/health")
 async def health_check():
     """Sunucu sağlık kontrolü."""
-    fal_key = os.getenv("FAL_KEY", "")
     return {
         "status": "ok",
-        "fal_key_configured": len(fal_key) > 0,
-        "npc_count": len(registry.list_npcs()),
-        "active_conversations": len(store.get_all_conversations()),
+        "fal_key_configured": _FAL_KEY_CONFIGURED,
+        "npc_count": registry.npc_count,
+        "active_conversations": store.conversation_count(),
     }
 
 
@@ -864,4 +1175,5 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
     logger.info(f"Atom Voice Backend başlatılıyor: {host}:{port}")
-    uvicorn.run(app, host=host, port=port, log_level="info")
+    # "auto": uvloop kuruluysa (Linux/macOS) onu, değilse (Windows) asyncio'yu kullanır
+    uvicorn.run(app, host=host, port=port, log_level="info", loop="auto")
@@ -3,19 +3,77 @@ NPC Registry — NPC tanımlarını yükler ve serve eder.
 JSON dosyasından veya Godot client'ından gelen NPC bilgilerini saklar.
 """
 
-import json
 import threading
+import orjson
 from pathlib import Path
+from types import MappingProxyType
 from typing import Optional
 
+# Dosya yolu → (mtime_ns, boyut, parse edilmiş veri). Değişmeyen dosya
+# yeniden okunup parse edilmez; veri hiç yerinde değiştirilmez
+_file_cache: dict[str, tuple[int, int, dict]] = {}
+
+
+def _read_json_cached(path: Path) -> dict:
+    """JSON dosyasını okur; mtime ve boyut aynıysa önceki parse sonucunu döner."""
+    st = path.stat()
+    key = str(path.resolve())
+    cached = _file_cache.get(key)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    data = orjson.loads(path.read_bytes())
+    _file_cache[key] = (st.st_mtime_ns, st.st_size, data)
+    return data
+
+
+def _deep_freeze(value):
+    """dict → MappingProxyType, list → tuple (iç içe, kopyalayarak).
+    Registry'deki NPC'lerin iç listeleri de (goals, secrets, actions) salt-okunur
+    olur ve _file_cache'teki parse sonucuyla nesne paylaşmaz."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _deep_freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_deep_freeze(v) for v in value)
+    return value
+
 
 class NPCRegistry:
     """NPC kayıt defteri. NPC bilgilerini yükler ve ID ile erişim sağlar."""
 
     def __init__(self):
-        self._npcs: dict[str, dict] = {}
-        self._main_story: str = ""
-        self._lock = threading.Lock()
+        # Copy-on-write: (main_story, npcs) tek bir immutable tuple olarak
+        # tutulur ve hiç yerinde değiştirilmez. Yazanlar yeni tuple kurup
+        # referansı tek atamayla değiştirir; okuyanlar lock almadan o anki
+        # snapshot'ı okur — hikaye ile NPC seti hiçbir zaman karışmaz
+        # NPC'ler yüklenirken bir kez (iç listeleri dahil) salt-okunur yapılır;
+        # okuyucular kopya almadan aynı nesneyi paylaşır
+        self._state: tuple[str, dict[str, MappingProxyType]] = ("", {})
+        self._write_lock = threading.Lock()  # Sadece yazanlar arasında
+        self._save_lock = threading.Lock()   # overwrite_and_save dosya yazımı
+        # Her değişiklikte artan sayaç — türetilmiş değerleri önbellekleyenler
+        # (prompt, liste vb.) bununla geçersizliği anlar
+        self._version: int = 0
+
+    @property
+    def version(self) -> int:
+        """Registry içeriğinin sürümü; her yükleme/silme işleminde artar."""
+        return self._version
+
+    @staticmethod
+    def _merge_npcs(base: dict, npcs_list: list[dict]) -> dict[str, MappingProxyType]:
+        """base'in kopyasına npcs_list'teki NPC'leri (iç içe) salt-okunur olarak ekler."""
+        new_npcs = dict(base)
+        for npc in npcs_list:
+            npc_id = npc.get("id")
+            if npc_id:
+                new_npcs[npc_id] = _deep_freeze(npc)
+        return new_npcs
+
+    def _publish(self, main_story: str, npcs: dict) -> None:
+        """Yeni snapshot'ı yayınlar. _write_lock altında çağrılmalı."""
+        self._state = (main_story, npcs)
+        self._version += 1
 
     def load_from_file(self, path: str | Path) -> int:
         """
@@ -26,16 +84,14 @@ class NPCRegistry:
         if not path.exists():
             raise FileNotFoundError(f"NPC config dosyası bulunamadı: {path}")
 
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = _read_json_cached(path)
 
-        with self._lock:
-            self._main_story = data.get("main_story", "")
-            npcs_list = data.get("npcs", [])
-            for npc in npcs_list:
-                npc_id = npc.get("id")
-                if npc_id:
-                    self._npcs[npc_id] = npc
+        npcs_list = data.get("npcs", [])
+        with self._write_lock:
+            self._publish(
+                data.get("main_story", ""),
+                self._merge_npcs(self._state[1], npcs_list),
+            )
 
         return len(npcs_list)
 
@@ -45,13 +101,12 @@ class NPCRegistry:
         Mevcut NPC'leri günceller/ekler.
         """
         npcs_list = npcs_data.get("npcs", [])
-        with self._lock:
-            if "main_story" in npcs_data:
-                self._main_story = npcs_data["main_story"]
-            for npc in npcs_list:
-                npc_id = npc.get("id")
-                if npc_id:
-                    self._npcs[npc_id] = npc
+        with self._write_lock:
+            main_story, npcs = self._state
+            self._publish(
+                npcs_data.get("main_story", main_story),
+                self._merge_npcs(npcs, npcs_list),
+            )
 
         return len(npcs_list)
 
@@ -62,60 +117,65 @@ class NPCRegistry:
         """
         npcs_list = npcs_data.get("npcs", [])
         save_path = Path(save_path)
-        
-        with self._lock:
-            # Önce temizle
-            self._npcs.clear()
-            self._main_story = npcs_data.get("main_story", "")
-            
-            # Yeni veriyi ekle
-            for npc in npcs_list:
-                npc_id = npc.get("id")
-                if npc_id:
-                    self._npcs[npc_id] = npc
-            
-            # Kaydet
-            with open(save_path, "w", encoding="utf-8") as f:
-                json.dump(npcs_data, f, ensure_ascii=False, indent=2)
-        
+
+        # Yeni dict ve dosya içeriği lock dışında hazırlanır
+        new_npcs = self._merge_npcs({}, npcs_list)
+        payload = orjson.dumps(npcs_data, option=orjson.OPT_INDENT_2)
+
+        # _save_lock: iki kayıt üst üste gelirse dosya ile bellek aynı sırada
+        # güncellenir. _write_lock sadece snapshot değişimi boyunca tutulur,
+        # disk IO'su diğer yazanları (load_from_data) bekletmez
+        with self._save_lock:
+            with self._write_lock:
+                self._publish(npcs_data.get("main_story", ""), new_npcs)
+
+            # Atomik kayıt: yarım yazılmış dosya hiç görünmez
+            tmp_path = save_path.with_suffix(save_path.suffix + ".tmp")
+            tmp_path.write_bytes(payload)
+            tmp_path.replace(save_path)
+            _file_cache.pop(str(save_path.resolve()), None)
+
         return len(npcs_list)
 
     def get_main_story(self) -> str:
-        """Global oyun hikayesini döner."""
-        with self._lock:
-            return self._main_story
+        """Global oyun hikayesini döner. Lock almaz (tek snapshot okuması)."""
+        return self._state[0]
+
 
+    def get_npc(self, npc_id: str) -> Optional[MappingProxyType]:
+        """Bir NPC'nin bilgilerini salt-okunur olarak döner. Bulunamazsa None.
+        Lock almaz, kopyalamaz — iç listeler tuple'dır; değiştirmek isteyen
+        kendi kopyasını (dict(npc), list(npc["goals"]) ...) almalı."""
+        return self._state[1].get(npc_id)
 
-    def get_npc(self, npc_id: str) -> Optional[dict]:
-        """Bir NPC'nin bilgilerini döner. Bulunamazsa None."""
-        with self._lock:
-            npc = self._npcs.get(npc_id)
-            if npc:
-                return dict(npc)  # Kopya döndür
-            return None
+    def list_npcs(self) -> list[MappingProxyType]:
+        """Tüm kayıtlı NPC'leri salt-okunur olarak listeler. Lock almaz."""
+        return list(self._state[1].values())
 
-    def list_npcs(self) -> list[dict]:
-        """Tüm kayıtlı NPC'leri listeler."""
-        with self._lock:
-            return [dict(npc) for npc in self._npcs.values()]
+    @property
+    def npc_count(self) -> int:
+        """Kayıtlı NPC sayısı — liste kopyalamadan, O(1)."""
+        return len(self._state[1])
 
     def has_npc(self, npc_id: str) -> bool:
-        """NPC kayıtlı mı kontrol eder."""
-        with self._lock:
-            return npc_id in self._npcs
+        """NPC kayıtlı mı kontrol eder. Lock almaz."""
+        return npc_id in self._state[1]
 
     def remove_npc(self, npc_id: str) -> bool:
         """NPC'yi kayıttan siler."""
-        with self._lock:
-            if npc_id in self._npcs:
-                del self._npcs[npc_id]
-                return True
-            return False
+        with self._write_lock:
+            main_story, npcs = self._state
+            if npc_id not in npcs:
+                return False
+            new_npcs = dict(npcs)
+            del new_npcs[npc_id]
+            self._publish(main_story, new_npcs)
+            return True
 
     def clear(self) -> None:
         """Tüm NPC kayıtlarını temizler."""
-        with self._lock:
-            self._npcs.clear()
+        with self._write_lock:
+            self._publish(self._state[0], {})
 
 
 # Global singleton
@@ -7,6 +7,8 @@ Connection pooling ile her istekte TCP+TLS handshake tekrarlanmaz.
 import os
 import time
 import logging
+import functools
+from typing import AsyncIterable
 import httpx
 
 logger = logging.getLogger(__name__)
@@ -15,10 +17,16 @@ logger = logging.getLogger(__name__)
 STT_ENDPOINT = os.getenv("STT_ENDPOINT", "freya-mypsdi253hbk/freya-stt")
 STT_MODEL = os.getenv("STT_MODEL", "freya-stt-v1")
 BASE_URL = f"https://fal.run/{STT_ENDPOINT}"
+_TRANSCRIBE_URL = f"{BASE_URL}/audio/transcriptions"
 FAL_KEY = os.getenv("FAL_KEY", "")
 
 _AUTH_HEADERS = {"Authorization": f"Key {FAL_KEY}"}
 
+# multipart boundary süreç başına bir kez üretilir (128 bit rastgele — ses
+# verisinde rastlanma ihtimali yok); envelope ve Content-Type tekrar kurulmaz
+_BOUNDARY = os.urandom(16).hex()
+_MULTIPART_CONTENT_TYPE = f"multipart/form-data; boundary={_BOUNDARY}"
+
 # Module-level persistent HTTP client — connection pooling
 _http_client: httpx.AsyncClient | None = None
 
@@ -28,49 +36,100 @@ def _get_client() -> httpx.AsyncClient:
     global _http_client
     if _http_client is None or _http_client.is_closed:
         _http_client = httpx.AsyncClient(
-            timeout=60.0,
+            http2=True,  # Eşzamanlı chunk STT'leri tek TLS bağlantısında multiplex edilir
+            headers=_AUTH_HEADERS,  # Her istekte tekrar merge edilmesin
+            timeout=httpx.Timeout(60.0, connect=5.0),
             limits=httpx.Limits(
-                max_connections=5,
-                max_keepalive_connections=2,
-                keepalive_expiry=30,
+                max_connections=20,
+                # Burst sonrası boşta kalan bağlantılar kapatılmadan havuzda kalır
+                max_keepalive_connections=20,
+                keepalive_expiry=120,
             ),
         )
     return _http_client
 
 
+def init_http_client() -> None:
+    """Client'ı startup'ta oluşturur (ilk istek beklemesin)."""
+    _get_client()
+
+
+async def close_http_client() -> None:
+    """Shutdown'da açık bağlantıları kapatır."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+@functools.lru_cache(maxsize=32)
+def _multipart_envelope(language: str, filename: str) -> tuple[bytes, bytes]:
+    """multipart/form-data gövdesinin ses verisinden önceki ve sonraki kısımlarını üretir.
+    Ses verisi bu iki parça arasına kopyalanmadan, akış halinde konur.
+    Sadece dil ve dosya adına bağlı olduğu için önbelleklenir."""
+    fields = {
+        "language": language,
+        "model": STT_MODEL,
+        "response_format": "json",
+    }
+    head = "".join(
+        f'--{_BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    ) + (
+        f'--{_BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: audio/wav\r\n\r\n"
+    )
+    tail = f"\r\n--{_BOUNDARY}--\r\n"
+    return head.encode(), tail.encode()
+
+
+async def _iter_body(head: bytes, audio: bytes | AsyncIterable[bytes], tail: bytes):
+    yield head
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        yield audio
+    else:
+        async for chunk in audio:
+            yield chunk
+    yield tail
+
+
 async def transcribe_audio(
-    audio_bytes: bytes,
+    audio: bytes | AsyncIterable[bytes],
     language: str = "tr",
     filename: str = "audio.wav",
+    size: int | None = None,
 ) -> dict:
     """
     Ses dosyasını metne çevirir.
+    audio bytes ya da async chunk iterable (ör. UploadFile'dan okunan parçalar)
+    olabilir; iterable verilirse ses belleğe tek parça halinde alınmadan
+    upstream'e akıtılır. size biliniyorsa Content-Length olarak gönderilir.
 
     Returns:
         {"text": "transkript metni", "stt_time_ms": 123.4}
     """
-    url = f"{BASE_URL}/audio/transcriptions"
-    files = {"file": (filename, audio_bytes, "audio/wav")}
-    data = {
-        "language": language,
-        "model": STT_MODEL,
-        "response_format": "json",
-    }
+    if size is None and isinstance(audio, (bytes, bytearray, memoryview)):
+        size = len(audio)
+
+    head, tail = _multipart_envelope(language, filename)
+    headers = {"Content-Type": _MULTIPART_CONTENT_TYPE}
+    if size is not None:
+        headers["Content-Length"] = str(len(head) + size + len(tail))
 
-    logger.info(f"STT isteği gönderiliyor ({len(audio_bytes)} bytes)...")
+    logger.info("STT isteği gönderiliyor (%s bytes)...", size if size is not None else "?")
     start_time = time.perf_counter()
 
     client = _get_client()
-    response = await client.post(url, headers=_AUTH_HEADERS, files=files, data=data)
+    response = await client.post(_TRANSCRIBE_URL, headers=headers, content=_iter_body(head, audio, tail))
     if response.status_code != 200:
-        logger.error(f"STT hata ({response.status_code}): {response.text}")
+        logger.error("STT hata (%d): %s", response.status_code, response.text)
     response.raise_for_status()
 
     elapsed_ms = (time.perf_counter() - start_time) * 1000
     result = response.json()
     text = result.get("text", "")
 
-    logger.info(f"STT tamamlandı: {elapsed_ms:.0f}ms — \"{text[:80]}\"")
+    logger.info("STT tamamlandı: %.0fms — \"%s\"", elapsed_ms, text[:80])
 
     return {
         "text": text,
@@ -5,12 +5,15 @@ Streaming sayesinde ilk ses chunk'ı hızlıca elde edilir.
 """
 
 import os
-import io
-import wave
 import time
-import base64
+import struct
+import asyncio
 import logging
+import functools
+import threading
 import fal_client
+from concurrent.futures import ThreadPoolExecutor
+from binascii import a2b_base64
 
 logger = logging.getLogger(__name__)
 
@@ -18,22 +21,97 @@ logger = logging.getLogger(__name__)
 TTS_ENDPOINT = os.getenv("TTS_ENDPOINT", "freya-mypsdi253hbk/freya-tts")
 SAMPLE_RATE = 16000  # PCM16 at 16kHz
 
+# İki fazlı ilk chunk: turun ilk cümlesinde TTS'ten daha sık / daha küçük
+# pencereyle chunk üretmesi istenir (TTFA düşer), sonraki cümleler varsayılan
+# kalite ayarlarıyla üretilir. 0 = parametre gönderilmez (endpoint varsayılanı).
+TTS_FIRST_CHUNK_EMIT_EVERY = int(os.getenv("TTS_FIRST_CHUNK_EMIT_EVERY", "0"))
+TTS_FIRST_CHUNK_DECODE_WINDOW = int(os.getenv("TTS_FIRST_CHUNK_DECODE_WINDOW", "0"))
+
+# Bloklayan fal stream'leri kendi thread havuzunda tüketilir — eşzamanlı TTS
+# akışları asyncio'nun varsayılan executor'ünü (to_thread) doldurup diğer
+# kısa işleri (log, dosya IO) bekletmez. Her TTS akışı sentez boyunca bir thread
+# tutar, yani bu değer süreç başına eşzamanlı TTS akışı üst sınırıdır; aşan
+# akışlar sırada bekler (ilk ses gecikir) ve uyarı loglanır. Thread'ler
+# ihtiyaç oldukça açılır, yüksek değer boşta maliyet getirmez.
+TTS_MAX_WORKERS = int(os.getenv("TTS_MAX_WORKERS", "100"))
+_fal_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix="fal-stream")
+# Havuza gönderilmiş, henüz bitmemiş iş sayısı (sadece event loop'ta değişir)
+_fal_in_flight = 0
+
+# text_to_speech_stream_async kuyruğunda akışın bittiğini işaretler
+_STREAM_END = object()
+
+
+def _run_on_fal_executor(loop: asyncio.AbstractEventLoop, func, *args) -> asyncio.Future:
+    """func'ı fal thread havuzunda çalıştırır. Havuz doluysa iş sıraya girer —
+    bu durum sessizce TTFA'yı uzatmasın diye uyarı loglanır."""
+    global _fal_in_flight
+    if _fal_in_flight >= TTS_MAX_WORKERS:
+        logger.warning(
+            "TTS thread havuzu dolu (%d/%d) — yeni akış sırada bekleyecek",
+            _fal_in_flight, TTS_MAX_WORKERS,
+        )
+    _fal_in_flight += 1
+    future = loop.run_in_executor(_fal_executor, func, *args)
+    future.add_done_callback(_fal_job_done)
+    return future
+
+
+def _fal_job_done(_future: asyncio.Future) -> None:
+    global _fal_in_flight
+    _fal_in_flight -= 1
+
+
+def shutdown_executor() -> None:
+    """Shutdown'da fal thread havuzunu kapatır; kuyruktaki işler iptal edilir."""
+    _fal_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _tts_arguments(text: str, voice: str, speed: float, first_chunk: bool) -> dict:
+    """fal.ai TTS isteğinin argümanlarını oluşturur.
+    first_chunk=True ise yapılandırılmış agresif ilk-chunk ayarları eklenir."""
+    arguments = {"input": text, "voice": voice, "speed": speed}
+    if first_chunk:
+        if TTS_FIRST_CHUNK_EMIT_EVERY > 0:
+            arguments["first_chunk_emit_every"] = TTS_FIRST_CHUNK_EMIT_EVERY
+        if TTS_FIRST_CHUNK_DECODE_WINDOW > 0:
+            arguments["first_chunk_decode_window"] = TTS_FIRST_CHUNK_DECODE_WINDOW
+    return arguments
+
+
+@functools.lru_cache(maxsize=4)
+def _wav_fmt_block(sample_rate: int) -> bytes:
+    """44 byte'lık WAV header'ının uzunluktan bağımsız orta kısmı
+    ("WAVE" + fmt chunk + "data" etiketi). Mono, 16-bit PCM."""
+    return struct.pack(
+        "<4s4sIHHIIHH4s",
+        b"WAVE", b"fmt ", 16,
+        1,                  # PCM
+        1,                  # Mono
+        sample_rate,
+        sample_rate * 2,    # byte rate (16-bit mono)
+        2,                  # block align
+        16,                 # bits per sample
+        b"data",
+    )
+
 
-def _pcm_to_wav(pcm_bytes: bytes, sample_rate: int = SAMPLE_RATE) -> bytes:
-    """Ham PCM16 verisini WAV formatına çevirir."""
-    buffer = io.BytesIO()
-    with wave.open(buffer, "wb") as wf:
-        wf.setnchannels(1)        # Mono
-        wf.setsampwidth(2)        # 16-bit (2 bytes)
-        wf.setframerate(sample_rate)
-        wf.writeframes(pcm_bytes)
-    return buffer.getvalue()
+def _pcm_to_wav(pcm_bytes: bytes | bytearray, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """Ham PCM16 verisini WAV formatına çevirir.
+    Header elle kurulur — wave modülü ve BytesIO kullanılmaz."""
+    data_len = len(pcm_bytes)
+    return b"".join((
+        b"RIFF", struct.pack("<I", data_len + 36),
+        _wav_fmt_block(sample_rate),
+        struct.pack("<I", data_len), pcm_bytes,
+    ))
 
 
 async def text_to_speech_wav(
     text: str,
     voice: str = "alloy",
     speed: float = 1.0,
+    first_chunk: bool = False,
 ) -> dict:
     """
     Metni sese çevirir (streaming ile PCM16 chunk'ları alıp WAV olarak birleştirir).
@@ -42,6 +120,7 @@ async def text_to_speech_wav(
         text: Seslendirmek istenen Türkçe metin
         voice: Ses seçimi ("alloy", "zeynep", "ali")
         speed: Oynatma hızı (0.25 - 4.0)
+        first_chunk: Turun ilk cümlesi mi (agresif ilk-chunk ayarları)
 
     Returns:
         {
@@ -51,36 +130,52 @@ async def text_to_speech_wav(
             "chunk_count": int
         }
     """
-    logger.info(f"TTS başlatılıyor: \"{text[:60]}...\" ses={voice} hız={speed}")
+    # fal_client.stream bloklayan bir iterator — tüm akış worker thread'de
+    # tüketilir, event loop diğer isteklere hizmet etmeye devam eder
+    loop = asyncio.get_running_loop()
+    return await _run_on_fal_executor(
+        loop, _text_to_speech_wav_blocking, text, voice, speed, first_chunk
+    )
+
+
+def _text_to_speech_wav_blocking(text: str, voice: str, speed: float, first_chunk: bool) -> dict:
+    """text_to_speech_wav'ın senkron gövdesi (thread'de çalışır)."""
+    logger.info("TTS başlatılıyor: \"%s...\" ses=%s hız=%s", text[:60], voice, speed)
     start_time = time.perf_counter()
 
-    audio_chunks: list[bytes] = []
+    pcm_buf = bytearray()  # Decode edilen PCM doğrudan buraya eklenir
     chunk_count = 0
     metadata: dict = {}
 
     try:
         stream = fal_client.stream(
             TTS_ENDPOINT,
-            arguments={"input": text, "voice": voice, "speed": speed},
+            arguments=_tts_arguments(text, voice, speed, first_chunk),
             path="/stream",
         )
 
+        # Döngüde chunk başına çağrılanlar local'e bağlanır (global/attribute
+        # lookup her chunk'ta tekrarlanmaz)
+        # fal'dan gelen base64 geçerli; b64decode sarmalayıcısına gerek yok
+        decode = a2b_base64
+        pcm_extend = pcm_buf.extend
+        perf_counter = time.perf_counter
+
         for event in stream:
             if "audio" in event:
                 chunk_count += 1
-                pcm_bytes = base64.b64decode(event["audio"])
-                audio_chunks.append(pcm_bytes)
+                pcm_extend(decode(event["audio"]))
 
                 if chunk_count == 1:
-                    first_chunk_ms = (time.perf_counter() - start_time) * 1000
-                    logger.info(f"TTS ilk chunk alındı: {first_chunk_ms:.0f}ms")
+                    first_chunk_ms = (perf_counter() - start_time) * 1000
+                    logger.info("TTS ilk chunk alındı: %.0fms", first_chunk_ms)
 
             if "error" in event:
                 is_recoverable = event.get("recoverable", False)
                 error_msg = event.get("error", {}).get("message", "Bilinmeyen hata")
                 if not is_recoverable:
                     raise RuntimeError(f"TTS hatası: {error_msg}")
-                logger.warning(f"TTS uyarı (kurtarılabilir): {error_msg}")
+                logger.warning("TTS uyarı (kurtarılabilir): %s", error_msg)
 
             if event.get("done"):
                 metadata = {
@@ -89,26 +184,25 @@ async def text_to_speech_wav(
                 }
 
     except Exception as e:
-        logger.error(f"TTS stream hatası: {e}")
-        if not audio_chunks:
+        logger.error("TTS stream hatası: %s", e)
+        if not pcm_buf:
             raise
 
     elapsed_ms = (time.perf_counter() - start_time) * 1000
 
-    if not audio_chunks:
+    if not pcm_buf:
         raise RuntimeError("TTS'den hiç ses chunk'ı alınamadı")
 
-    # PCM chunk'larını birleştir ve WAV'a dönüştür
-    all_pcm = b"".join(audio_chunks)
-    wav_bytes = _pcm_to_wav(all_pcm)
+    # Biriken PCM'i WAV'a dönüştür (join bytearray'i doğrudan kabul eder)
+    wav_bytes = _pcm_to_wav(pcm_buf)
 
     # Gerçek ses süresini hesapla
-    total_samples = len(all_pcm) // 2  # 16-bit = 2 bytes per sample
+    total_samples = len(pcm_buf) // 2  # 16-bit = 2 bytes per sample
     actual_duration_sec = total_samples / SAMPLE_RATE
 
     logger.info(
-        f"TTS tamamlandı: {elapsed_ms:.0f}ms, {chunk_count} chunk, "
-        f"{actual_duration_sec:.1f}s ses"
+        "TTS tamamlandı: %.0fms, %d chunk, %.1fs ses",
+        elapsed_ms, chunk_count, actual_duration_sec,
     )
 
     return {
@@ -123,12 +217,15 @@ def text_to_speech_stream(
     text: str,
     voice: str = "alloy",
     speed: float = 1.0,
+    first_chunk: bool = False,
 ):
     """
     TTS streaming generator — fal.ai'den gelen PCM16 chunk'larını
     base64 olarak olduğu gibi yield eder. WAV'a dönüştürme YAPMAZ.
 
     Godot tarafında AudioStreamGenerator ile doğrudan çalınabilir.
+    first_chunk=True turun ilk cümlesi içindir: TTS_FIRST_CHUNK_* ayarları
+    gönderilir, sonraki cümleler varsayılan (kalite odaklı) ayarla üretilir.
 
     Yields:
         dict: Her biri aşağıdaki tiplerden biri:
@@ -138,7 +235,7 @@ def text_to_speech_stream(
             - {"type": "done", "tts_total_ms": float, "tts_first_chunk_ms": float, "chunk_count": int, ...}
             - {"type": "error", "error": str}
     """
-    logger.info(f"TTS stream başlatılıyor: \"{text[:60]}...\" ses={voice} hız={speed}")
+    logger.info("TTS stream başlatılıyor: \"%s...\" ses=%s hız=%s", text[:60], voice, speed)
     start_time = time.perf_counter()
 
     chunk_count = 0
@@ -147,7 +244,7 @@ def text_to_speech_stream(
     try:
         stream = fal_client.stream(
             TTS_ENDPOINT,
-            arguments={"input": text, "voice": voice, "speed": speed},
+            arguments=_tts_arguments(text, voice, speed, first_chunk),
             path="/stream",
         )
 
@@ -157,7 +254,7 @@ def text_to_speech_stream(
 
                 if chunk_count == 1:
                     first_chunk_ms = (time.perf_counter() - start_time) * 1000
-                    logger.info(f"TTS ilk chunk alındı: {first_chunk_ms:.0f}ms")
+                    logger.info("TTS ilk chunk alındı: %.0fms", first_chunk_ms)
                     yield {
                         "type": "audio",
                         "audio": event["audio"],  # zaten base64
@@ -175,18 +272,20 @@ def text_to_speech_stream(
                 is_recoverable = event.get("recoverable", False)
                 error_msg = event.get("error", {}).get("message", "Bilinmeyen hata")
                 if not is_recoverable:
-                    logger.error(f"TTS stream hatası (kurtarılamaz): {error_msg}")
+                    logger.error("TTS stream hatası (kurtarılamaz): %s", error_msg)
                     yield {"type": "error", "error": error_msg}
                     return
-                logger.warning(f"TTS uyarı (kurtarılabilir): {error_msg}")
+                logger.warning("TTS uyarı (kurtarılabilir): %s", error_msg)
 
             if event.get("done"):
                 total_ms = (time.perf_counter() - start_time) * 1000
-                logger.info(
-                    f"TTS stream tamamlandı: {total_ms:.0f}ms, {chunk_count} chunk, "
-                    f"ilk chunk: {first_chunk_ms:.0f}ms" if first_chunk_ms else
-                    f"TTS stream tamamlandı: {total_ms:.0f}ms, {chunk_count} chunk"
-                )
+                if first_chunk_ms:
+                    logger.info(
+                        "TTS stream tamamlandı: %.0fms, %d chunk, ilk chunk: %.0fms",
+                        total_ms, chunk_count, first_chunk_ms,
+                    )
+                else:
+                    logger.info("TTS stream tamamlandı: %.0fms, %d chunk", total_ms, chunk_count)
                 yield {
                     "type": "done",
                     "tts_total_ms": round(total_ms, 1),
@@ -197,7 +296,7 @@ def text_to_speech_stream(
                 }
 
     except Exception as e:
-        logger.error(f"TTS stream hatası: {e}")
+        logger.error("TTS stream hatası: %s", e)
         if chunk_count == 0:
             yield {"type": "error", "error": str(e)}
         else:
@@ -210,3 +309,38 @@ def text_to_speech_stream(
                 "error": str(e),
                 "partial": True,
             }
+
+
+async def text_to_speech_stream_async(
+    text: str,
+    voice: str = "alloy",
+    speed: float = 1.0,
+    first_chunk: bool = False,
+):
+    """
+    text_to_speech_stream'in async karşılığı — aynı event'leri yield eder.
+
+    fal_client.stream bloklayan bir generator olduğu için tek bir worker
+    thread'de tüketilir; event'ler call_soon_threadsafe ile event loop'taki
+    asyncio.Queue'ya aktarılır. Event loop hiçbir zaman bloklanmaz.
+    Tüketici erken çıkarsa (aclose / iptal) worker bir sonraki event'te durur.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for event in text_to_speech_stream(text, voice=voice, speed=speed, first_chunk=first_chunk):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(events.put_nowait, event)
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, _STREAM_END)
+
+    _run_on_fal_executor(loop, pump)
+    try:
+        while (event := await events.get()) is not _STREAM_END:
+            yield event
+    finally:
+        stop.set()